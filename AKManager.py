@@ -2,6 +2,7 @@ import sys
 import redis
 from configparser import ConfigParser
 import datetime
+from utils.AKLimiter import AKLimiter
 
 # 加载配置
 conf = ConfigParser()
@@ -53,13 +54,20 @@ class AK_Manager:
         """
         return self.r.scard(self.ak_db)
 
+    def usage_from_db(self):
+        """
+        返回当日各AK已用请求数
+        :return:
+        """
+        return AKLimiter(self.r, self.ak_db, conf.getint('ak', 'qps'), conf.getint('ak', 'daily_quota')).usage()
+
 
 if __name__ == '__main__':
 
     akmanager = AK_Manager()
 
     if len(sys.argv) <= 1:
-        print("请输入执行参数 1 - 打印剩余AK数量 0 - 重置AK队列")
+        print("请输入执行参数 1 - 打印剩余AK数量 0 - 重置AK队列 3 - 打印当日AK用量")
     elif sys.argv[1] == '0':
         akmanager.reset()
         print(datetime.datetime.now() , "AK队列已重置")
@@ -67,3 +75,5 @@ if __name__ == '__main__':
         print("队列剩余AK数量: ", akmanager.count_ak_from_db())
     elif sys.argv[1] == '2':
         print("队列剩余AK: ", akmanager.get_ak_from_db())
+    elif sys.argv[1] == '3':
+        print("当日AK用量: ", akmanager.usage_from_db())
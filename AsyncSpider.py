@@ -0,0 +1,340 @@
+import os
+import socket
+import time
+import json
+import asyncio
+import logging
+import aiohttp
+from urllib.parse import urlsplit
+from redis import asyncio as aioredis
+from utils.AKLimiter import AsyncAKLimiter, NoAKError
+from utils.VisitedSet import get_visited_set
+from utils.RetryScheduler import AsyncRetryScheduler, CircuitOpenError
+from utils.TaskQueue import AsyncTaskQueue
+from utils.ChangeDetector import AsyncChangeDetector
+from Spider import conf, headers, proxy_pool, upstream_breaker, response_cache, update_flag, refresh_flag, enrich_flag, region_str, box_str, detail_str, aoi_str, \
+    gaode_region_poi, parse_poi_base, aoi_to_wkt, dump_task, load_task, BAIDU, GAODE, status_action, counts_attempt, \
+    plan_total, pending_pages, collect_pages, unique_results, fingerprint_results, needs_attribute, parse_attribute
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncSpider(object):
+    """
+    异步采集器,单进程内维持大量并发请求,任务语义与Spider一致
+    """
+
+    def __init__(self, concurrency=None):
+        # 连接数达到上限时等待空闲连接, 而不是抛出MaxConnectionsError
+        self.__r = aioredis.Redis(connection_pool=aioredis.BlockingConnectionPool(
+            host=conf.get('redis', 'host'), password=conf.get('redis', 'password'),
+            max_connections=conf.getint('redis', 'async_max_connections')))
+        self.__task_db = conf.get('redis', 'task_db')
+        self.__visit_db = conf.get('redis', 'visit_db')
+        self.__ak_db = conf.get('redis', 'ak_db')
+        self.__result_db = conf.get('redis', 'result_db')
+        self.__enrich_db = conf.get('redis', 'enrich_db')
+        self.__visited = get_visited_set(self.__r, conf, is_async=True)
+        self.__detector = AsyncChangeDetector(self.__r, conf.get('redis', 'fingerprint_db'),
+                                              conf.get('redis', 'seen_db'))
+        self.__ak_limiter = AsyncAKLimiter(self.__r, self.__ak_db, conf.getint('ak', 'qps'),
+                                           conf.getint('ak', 'daily_quota'), conf.getint('ak', 'lease_timeout'))
+        self.__retry = AsyncRetryScheduler(self.__r, self.__task_db, conf.get('redis', 'delay_db'),
+                                           conf.get('redis', 'dead_db'), conf.getint('retry', 'max_attempts'),
+                                           conf.getint('retry', 'base_delay'), conf.getint('retry', 'max_delay'))
+
+        self.__mode = conf.get('common', 'mode')  # grid / city
+        # 同时在途的HTTP请求上限
+        self.__concurrency = concurrency if concurrency else conf.getint('common', 'concurrency')
+        self.__semaphore = None
+        self.__session = None
+        # 每个进程一个处理中列表与租约, 由单个领取协程阻塞领取, 任务协程处理后确认
+        self.__queue = AsyncTaskQueue(self.__r, self.__task_db, '%s:%d' % (socket.gethostname(), os.getpid()),
+                                      conf.getint('queue', 'lease_timeout'), conf.getint('queue', 'reap_interval'))
+        self.__block_timeout = conf.getint('queue', 'block_timeout')
+        self.__tasks = None
+
+    async def __get_ak(self):
+        # 租用余量最大的AK, 所有AK令牌不足时挂起等待
+        return await self.__ak_limiter.lease()
+
+    async def __is_empty_ak(self):
+        # 集合中的AK可能当日额度已用尽, 按额度余量判断
+        return await self.__ak_limiter.available() == 0
+
+    async def __reset_task(self, keyword, region, **state):
+        await self.__r.lpush(self.__task_db, dump_task(region, keyword, **state))
+
+    async def __retry_task(self, keyword, region, count=True, **state):
+        # 失败任务进入延迟队列, AK限流、熔断等与任务本身无关的失败不计入次数
+        if count:
+            state['attempt'] = state.get('attempt', 0) + 1
+        if not await self.__retry.schedule(dump_task(region, keyword, **state), state.get('attempt', 0)):
+            logger.error("uid采集器: 任务失败%d次,转入死信队列 %s" % (state['attempt'], region))
+
+    async def __push_tasks(self, tasks):
+        # 子任务推送到队列前端, 任意worker均可领取
+        if tasks:
+            await self.__r.lpush(self.__task_db, *tasks)
+
+    async def __remove_ak(self, ak):
+        if ak:
+            await self.__r.srem(self.__ak_db, ak)
+
+    async def __is_visited(self, uids):
+        # 一次查询整页uid
+        return await self.__visited.contains_many(uids)
+
+    async def __request_url(self, url):
+        host = urlsplit(url).netloc
+        if not upstream_breaker.allow(host):
+            raise CircuitOpenError(host)
+        async with self.__semaphore:
+            # 代理池仅在补充代理时访问代理服务, 放到线程中避免阻塞事件循环
+            proxy = await asyncio.to_thread(proxy_pool.get) if proxy_pool else None
+
+            start = time.time()
+            try:
+                async with self.__session.get(url, headers=headers,
+                                              proxy='http://' + proxy if proxy else None) as resp:
+                    content = await resp.json(content_type=None)
+            except Exception:
+                # 经代理的失败计入代理, 直连失败计入上游主机
+                if proxy:
+                    proxy_pool.report(proxy, False)
+                else:
+                    upstream_breaker.record(host, False)
+                raise
+            if proxy:
+                proxy_pool.report(proxy, True, time.time() - start)
+            upstream_breaker.record(host, True)
+            return content
+
+    async def get_aoi(self, uid):
+        """
+        给定UID,采集AOI和bound,转换坐标系
+        :param uid:
+        :return:  AOI WKT
+        """
+        # 缓存文件与其他进程共享, 等待写锁时不能阻塞事件循环, 读写放到线程中
+        content = await asyncio.to_thread(response_cache.get, 'aoi', uid) if response_cache else None
+        if content is None:
+            content = (await self.__request_url(aoi_str % uid)).get('content').get('geo') or ''
+            if response_cache:
+                await asyncio.to_thread(response_cache.set, 'aoi', uid, content)
+        if content:
+            return aoi_to_wkt(content)
+        return
+
+    async def __get_detail(self, uid):
+        content = await asyncio.to_thread(response_cache.get, 'detail', uid) if response_cache else None
+        if content is None:
+            ak = await self.__get_ak()
+            if not ak:
+                return None
+            content = (await self.__request_url(detail_str.format(uid=uid, ak=ak)))['result']
+            if response_cache:
+                await asyncio.to_thread(response_cache.set, 'detail', uid, content)
+        return content
+
+    async def __get_attribute(self, uid):
+        return parse_attribute(await self.__get_detail(uid))
+
+    async def __push_results(self, results):
+        # 未访问过的结果标记已访问并推送, 整页一次往返
+        return await self.__visited.add_and_push([(result['uid'], json.dumps(result)) for result in results],
+                                                 self.__enrich_db if enrich_flag else self.__result_db)
+
+    async def __push_changed(self, results, fingerprints):
+        # 刷新模式下已访问的POI同样推送, 指纹随结果推送, 入库后由Persist.py写入
+        if not results:
+            return 0
+        await self.__visited.add_many([result['uid'] for result in results])
+        for result in results:
+            result['fingerprint'] = fingerprints[result['uid']]
+        return await self.__r.rpush(self.__enrich_db if enrich_flag else self.__result_db,
+                                    *[json.dumps(result) for result in results])
+
+    async def enrich_poi(self, poi_info):
+        """
+        补充AOI与详情属性
+        :param poi_info: 检索阶段解析的基础POI
+        :return: 补充后的POI
+        """
+        uid = poi_info['uid']
+        # AOI与详情互不依赖, 并发请求
+        if needs_attribute(poi_info['tag']):
+            aoi, attribute = await asyncio.gather(self.get_aoi(uid), self.__get_attribute(uid))
+        else:
+            aoi, attribute = await self.get_aoi(uid), None
+        if aoi:
+            poi_info['aoi'] = aoi
+        if attribute:
+            poi_info['attribute'] = attribute
+        return poi_info
+
+    async def __parse_poi_info(self, uid, content):
+        poi_info = parse_poi_base(uid, content)
+        # 两阶段模式下AOI与详情由Enrich.py补充
+        return poi_info if enrich_flag else await self.enrich_poi(poi_info)
+
+    async def __parse_result(self, region, uid, result):
+        try:
+            return await self.__parse_poi_info(uid, result)
+        except Exception:
+            logger.info("uid采集器: 获得结果异常 %s %s" % (region, uid))
+
+    async def __save_results(self, region, results, uid_key, check_visited, refresh=False):
+        """
+        多页结果合并后按uid去重, 批量检查已访问, 并发解析后批量推送
+        :param refresh: 刷新模式, 按指纹只处理新增或变化的POI
+        """
+        unique = unique_results(results, uid_key)
+        uids = list(unique.keys())
+        fingerprints = {}
+        if refresh:
+            # 未变化的uid只更新last seen, 不再请求AOI与详情
+            fingerprints = fingerprint_results(unique)
+            uids = await self.__detector.changed(fingerprints)
+        # 检查是否访问过该目标
+        elif check_visited:
+            uids = [uid for uid, visited in zip(uids, await self.__is_visited(uids)) if not visited]
+
+        poi_infos = await asyncio.gather(*[self.__parse_result(region, uid, unique[uid]) for uid in uids])
+        poi_infos = [poi_info for poi_info in poi_infos if poi_info]
+        if refresh:
+            await self.__push_changed(poi_infos, fingerprints)
+        else:
+            await self.__push_results(poi_infos)
+
+    async def __request_page(self, url_format_str, page_num, **params):
+        ak = await self.__get_ak()
+        if not ak:
+            # 未租到AK不发出请求, 由调用方延迟重试且不计失败次数
+            raise NoAKError(url_format_str.split('?')[0])
+        url = url_format_str.format(ak=ak, page_num=page_num, **params)
+        return ak, url, await self.__request_url(url)
+
+    async def __request_pages(self, url_format_str, pages, **params):
+        """
+        并发请求多页结果, 按页码顺序返回 (page, ak, url, content), 请求异常的页content为异常对象
+        """
+        contents = await asyncio.gather(*[self.__request_page(url_format_str, page, **params) for page in pages],
+                                        return_exceptions=True)
+        return [(page, None, None, content) if isinstance(content, Exception) else (page,) + content
+                for page, content in zip(pages, contents)]
+
+    async def __handle_status(self, source, content, ak, keyword, region, **state):
+        action = status_action(source, content, ak)
+        if action == 'reset':
+            await self.__remove_ak(ak)  # 删除 队列 ak
+            await self.__reset_task(keyword, region, **state)  # 推送该失败box到队列前端, 由其他AK重试
+        elif action == 'dead':
+            await self.__retry.dead(dump_task(region, keyword, **state))
+        else:
+            await self.__retry_task(keyword, region, count=action == 'retry', **state)
+
+    async def __handle_error(self, source, error, keyword, region, **state):
+        if isinstance(error, Exception):
+            await self.__retry_task(keyword, region, count=counts_attempt(error), **state)
+        else:
+            await self.__handle_status(source, error[0], error[1], keyword, region, **state)
+
+    async def __claw(self, source, url_format_str, params, keyword, region, state, check_visited, refresh=False):
+        """
+        首页返回总数后, 其余页并发请求, 合并去重后推送
+        部分页失败时任务记录总数与已完成页(total, done), 重试只请求未完成的页
+        :param params: 检索URL参数
+        """
+        results = []
+        if 'total' not in state:
+            # 访问请求
+            try:
+                ak, url, content = await self.__request_page(url_format_str, 0, **params)
+            except Exception as e:
+                logger.error("Error Code : 001 . 区域检索访问异常: %s " % region)
+                await self.__handle_error(source, e, keyword, region, **state)
+                return
+            if content['status'] != 0:
+                await self.__handle_status(source, content, ak, keyword, region, **state)
+                return
+            proceed, tasks = plan_total(source, keyword, region, content[source.total], state.get('depth', 0), url)
+            await self.__push_tasks(tasks)
+            if not proceed:
+                return
+            results.extend(content[source.results])
+            state.update(total=content[source.total], done=1)
+
+        pages = await self.__request_pages(url_format_str, pending_pages(source, state), **params)
+        page_results, error = collect_pages(source, region, pages, state)
+        # 已成功的页先入库, 失败页按状态码处理, 重试时从检查点继续
+        await self.__save_results(region, results + page_results, source.uid_key, check_visited, refresh)
+        if error:
+            await self.__handle_error(source, error, keyword, region, **state)
+
+    async def claw_by_region(self, keyword, region, **state):
+        """
+        行政区划采集器 , 支持以$合并的多关键字检索, 结果按自身tag归类
+        :return:
+        """
+        url_format_str = box_str if region.find(",") >= 0 else region_str
+        await self.__claw(BAIDU, url_format_str, dict(query=keyword, region=region), keyword, region, state,
+                          not update_flag, refresh_flag)
+
+    async def claw_gaode_poi(self, keyword, region, **state):
+        tag, query = keyword.split(';') if keyword.find(';') >= 0 else (None, keyword)
+        await self.__claw(GAODE, gaode_region_poi, dict(tag=tag, region=region), keyword, region, state, True)
+
+    async def __fetch(self):
+        """
+        领取协程: 进程内唯一的阻塞领取, 任务协程均忙时等待
+        """
+        while True:
+            try:
+                if await self.__is_empty_ak():
+                    logger.info("主程序: AK已用尽,等待60s...")
+                    await asyncio.sleep(60)
+                    continue
+                # 到期的延迟重试任务移回任务队列, 回收失效worker未完成的任务
+                await self.__retry.promote()
+                await self.__queue.reap()
+                task = await self.__queue.get(self.__block_timeout)
+                if not task:
+                    continue
+                await self.__tasks.put(task)
+            except Exception:
+                logger.exception("主程序: 领取任务异常,等待5s...")
+                await asyncio.sleep(5)
+
+    async def __worker(self):
+        while True:
+            task = await self.__tasks.get()
+            region, keyword, state = load_task(task)
+            try:
+                try:
+                    await self.claw_by_region(keyword, region, **state)
+                except Exception:
+                    logger.exception("主程序: 任务执行异常 %s" % task)
+                    await self.__retry_task(keyword, region, **state)
+                await self.__queue.ack(task)
+            except Exception:
+                # 未确认的任务留在处理中列表, 租约过期后回收
+                logger.exception("主程序: 任务确认异常 %s" % task)
+
+    async def run_spider(self):
+        """
+        启动一个领取协程与并发数相同的任务协程, 所有HTTP请求共享一个连接池和并发上限
+        """
+        self.__semaphore = asyncio.Semaphore(self.__concurrency)
+        self.__tasks = asyncio.Queue(1)
+        connector = aiohttp.TCPConnector(limit=self.__concurrency)
+        timeout = aiohttp.ClientTimeout(total=30)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            self.__session = session
+            self.__queue.start_heartbeat()
+            await asyncio.gather(self.__fetch(), *[self.__worker() for _ in range(self.__concurrency)])
+
+
+if __name__ == '__main__':
+    asyncio.run(AsyncSpider().run_spider())
+    print("exit..")
@@ -0,0 +1,152 @@
+import os
+import sys
+from PushRegion import conf, r, len_geohash, merge_flag, plan_queries, parse_city_to_sample_points
+from utils.TilePlanCache import TilePlanCache
+from utils.DensityPlanner import DensityPlanner
+
+task_db = conf.get('redis', 'task_db')
+delay_db = conf.get('redis', 'delay_db')
+mode = conf.get('common', 'mode')
+# 每条RPUSH的任务数, 每次往返的命令数
+batch_size = conf.getint('queue', 'dispatch_batch')
+pipeline_size = 10
+density_flag = conf.get('density', 'enable') == 'true'
+
+
+def task_key(task):
+    """
+    去掉附加状态, 只保留 region#keyword
+    """
+    return '#'.join(task.split('#')[:2])
+
+
+def queued_tasks():
+    """
+    已在任务队列、处理中列表与延迟重试队列中的任务
+    """
+    tasks = set()
+    for key in [task_db] + list(r.scan_iter(task_db + ':processing:*')):
+        for start in range(0, r.llen(key), batch_size):
+            tasks.update(task_key(task.decode('utf8')) for task in r.lrange(key, start, start + batch_size - 1))
+    for task, score in r.zscan_iter(delay_db, count=batch_size):
+        tasks.add(task_key(task.decode('utf8')))
+    return tasks
+
+
+def expand_keywords(keywords):
+    """
+    逗号分隔的关键字, @开头的为 [category] 大类, 展开为其全部小类
+    """
+    result = []
+    for keyword in keywords.split(','):
+        if keyword.startswith('@'):
+            items = conf.get('category', keyword[1:]).split(',')
+        else:
+            items = [keyword]
+        for item in items:
+            if item not in result:
+                result.append(item)
+    return result
+
+
+def resolve_cities(regions, tiles):
+    """
+    逗号分隔的 省/市/全国 展开为城市列表
+    """
+    provinces = tiles.provinces()
+    cities = []
+    for region in regions.split(','):
+        if region == '全国':
+            items = list(zip(*conf.items('city')))[0]
+        else:
+            items = provinces.get(region, [region])
+        for item in items:
+            if item not in cities:
+                cities.append(item)
+    return cities
+
+
+def get_planner():
+    from utils.DBManager import DBManager
+    serialize_db = conf.get('common', 'serialize_db')
+    db = DBManager(conf.get(serialize_db, 'host'), db=conf.get(serialize_db, 'database'),
+                   user=conf.get(serialize_db, 'username'), password=conf.get(serialize_db, 'password'),
+                   dbtype=serialize_db)
+    return DensityPlanner(db, conf.get(serialize_db, 'table'), conf.getint('density', 'min_length'),
+                          conf.getint('density', 'max_length'), margin=conf.getfloat('density', 'margin'))
+
+
+def iter_regions(regions, queries):
+    """
+    :return: 生成 (城市或省, {检索词: 检索区域列表}), 栅格模式下为城市的切片矩形, 每个城市只切片一次;
+             开启密度切片时按检索词对应类型的历史POI密度分别切片
+    """
+    if mode == 'city':
+        for region in regions.split(','):
+            items = list(zip(*conf.items('city')))[0] if region == '全国' else [region]
+            for item in items:
+                yield item, dict.fromkeys(queries, [item])
+        return
+    city_file = conf.get("common", "city_file")
+    if not (city_file and os.path.isfile(city_file)):
+        print("spider.conf=>[common] city_file 存在错误")
+        exit(-1)
+    tiles = TilePlanCache(city_file, conf.get('common', 'tile_cache_dir'), len_geohash)
+    planner = get_planner() if density_flag else None
+    for city in resolve_cities(regions, tiles):
+        if planner is None:
+            yield city, dict.fromkeys(queries, parse_city_to_sample_points(city, tiles))
+            continue
+        if city not in tiles.cities:
+            print(F"{city} 不存在,请检查名称")
+            exit(-1)
+        polygon = tiles.polygon(city)
+        yield city, {query: [','.join(map(str, area)) for area in planner.plan(polygon, query.split('$'))]
+                     for query in queries}
+
+
+def dispatch(regions, keywords):
+    """
+    :return: (推送任务数, 已在队列中跳过的任务数)
+    """
+    keywords = expand_keywords(keywords)
+    queries = plan_queries(','.join(keywords)) if merge_flag else keywords
+    queued = queued_tasks()
+    pipe = r.pipeline(transaction=False)
+    buffer, pushed, skipped = [], 0, 0
+
+    def flush(force=False):
+        nonlocal buffer
+        if buffer:
+            pipe.rpush(task_db, *buffer)
+            buffer = []
+        if len(pipe) >= pipeline_size or (force and len(pipe)):
+            pipe.execute()
+
+    for name, plans in iter_regions(regions, queries):
+        n = 0
+        for query, areas in plans.items():
+            for area in areas:
+                task = area + '#' + query
+                if task in queued:
+                    skipped += 1
+                    continue
+                queued.add(task)
+                buffer.append(task)
+                n += 1
+                if len(buffer) >= batch_size:
+                    flush()
+        pushed += n
+        print("push %s region to queue : %d tasks" % (name, n))
+    flush(force=True)
+    return pushed, skipped
+
+
+if __name__ == '__main__':
+    # python Dispatch.py 省或市或全国[,...] 关键字或@大类[,...]
+    if len(sys.argv) < 3:
+        print("参数错误")
+        exit(0)
+    assert mode in ('city', 'grid')
+    pushed, skipped = dispatch(sys.argv[1], sys.argv[2])
+    print("%d tasks pushed, %d already queued" % (pushed, skipped))
@@ -0,0 +1,64 @@
+import json
+import redis
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from utils.TaskQueue import TaskQueue
+from Spider import Spider, conf, response_cache
+
+logger = logging.getLogger(__name__)
+
+
+class Enricher(object):
+    """
+    两阶段采集的补充阶段: 消费检索阶段推送的基础POI, 补充AOI与详情后推送到结果队列
+    """
+
+    def __init__(self):
+        self.__r = redis.Redis(conf.get('redis', 'host'), password=conf.get('redis', 'password'))
+        self.__enrich_db = conf.get('redis', 'enrich_db')
+        self.__result_db = conf.get('redis', 'result_db')
+        # 取出的POI移入本进程的处理中列表, 推送结果或重试后才确认, 进程崩溃后由租约过期回收
+        self.__queue = TaskQueue(self.__r, self.__enrich_db, lease_timeout=conf.getint('queue', 'lease_timeout'),
+                                 reap_interval=conf.getint('queue', 'reap_interval'))
+        self.__block_timeout = conf.getint('queue', 'block_timeout')
+        self.__batch = conf.getint('common', 'enrich_batch')
+        self.__attempts = conf.getint('common', 'enrich_attempts')
+        self.__executor = ThreadPoolExecutor(conf.getint('common', 'enrich_concurrency'))
+        self.__spider = Spider()
+
+    def __enrich(self, poi_info):
+        try:
+            return self.__spider.enrich_poi(poi_info), True
+        except Exception:
+            logger.info("补充采集器: AOI/详情采集异常 %s" % poi_info['uid'])
+            return poi_info, False
+
+    def run_enricher(self):
+        self.__queue.start_heartbeat()
+        while True:
+            self.__queue.reap()
+            items = self.__queue.get_many(self.__batch, self.__block_timeout)
+            if not items:
+                logger.info("补充采集器: 队列为空")
+                continue
+
+            results, retries = [], []
+            for poi_info, success in self.__executor.map(self.__enrich, [json.loads(item) for item in items]):
+                attempt = poi_info.pop('attempt', 0) + 1
+                if success or attempt >= self.__attempts:
+                    # 多次失败的POI不再等待AOI, 以基础信息入库
+                    results.append(json.dumps(poi_info))
+                else:
+                    poi_info['attempt'] = attempt
+                    retries.append(json.dumps(poi_info))
+            if results:
+                self.__r.rpush(self.__result_db, *results)
+            if retries:
+                self.__r.rpush(self.__enrich_db, *retries)
+            self.__queue.ack_many(items)
+            if response_cache:
+                logger.info("补充采集器: 响应缓存 %s" % response_cache.stats())
+
+
+if __name__ == '__main__':
+    Enricher().run_enricher()
@@ -1,5 +1,7 @@
+import time
 import redis
 from configparser import ConfigParser
+from utils.VisitedSet import get_visited_set
 
 # 加载配置
 conf = ConfigParser()
@@ -9,6 +11,9 @@ conf.read("spider.conf", encoding='utf-8')
 r = redis.Redis(conf.get("redis","host"),password=conf.get("redis","password"))
 ak_db = conf.get('redis','ak_db')
 task_db = conf.get('redis','task_db')
-visit_db = conf.get('redis','visit_db')
+visited = get_visited_set(r, conf)
 result_db = conf.get('redis','result_db')
-print("1. 剩余AK\t{ak}\n2. 任务队列\t{task}\n3. 存储队列\t{results}\n4. 已访问集合\t{visited}\n".format( ak=r.scard(ak_db) , task=r.llen(task_db) , results=r.llen(result_db) , visited=r.scard(visit_db)))
+enrich_db = conf.get('redis','enrich_db')
+delay_db = conf.get('redis','delay_db')
+dead_db = conf.get('redis','dead_db')
+print("1. 剩余AK\t{ak}\n2. 任务队列\t{task}\n3. 活跃worker\t{workers}\n4. 延迟重试\t{delay}\n5. 死信队列\t{dead}\n6. 补充队列\t{enrich}\n7. 存储队列\t{results}\n8. 已访问集合\t{visited}\n".format( ak=r.scard(ak_db) , task=r.llen(task_db) , workers=r.zcount(task_db + ':leases', time.time(), '+inf') , delay=r.zcard(delay_db) , dead=r.llen(dead_db) , enrich=r.llen(enrich_db) , results=r.llen(result_db) , visited=visited.count()))
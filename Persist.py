@@ -1,42 +1,293 @@
+import sys
+import zlib
 import redis
+import asyncio
 import time
 import json
+import queue
+import socket
+import logging
+import threading
+from redis import asyncio as aioredis
 from utils.DBManager import DBManager
+from utils.AsyncDBManager import AsyncDBManager
+from utils.TaskQueue import TaskQueue, AsyncTaskQueue
+from utils.ChangeDetector import ChangeDetector, AsyncChangeDetector
 from configparser import ConfigParser
 
 conf = ConfigParser()
 conf.read("spider.conf", encoding='utf-8')
 
+logging.basicConfig(filename="persist.log", filemode="a",
+                    format="%(asctime)s %(name)s:%(levelname)s:%(message)s", datefmt="%Y-%m-%d %H:%M:%S",
+                    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
 serialize_db = conf.get('common', 'serialize_db')
+db_src = conf.get('redis', 'result_db')
+db_dead = conf.get('redis', 'persist_dead_db')
+seen_db = conf.get('redis', 'seen_db')
+fingerprint_db = conf.get('redis', 'fingerprint_db')
+db_obj = conf.get(serialize_db, 'table')
+# 批量大小、最长攒批秒数、写入线程数、单批写入尝试次数
+batch_size = conf.getint('persist', 'batch_size')
+flush_interval = conf.getfloat('persist', 'flush_interval')
+writers = conf.getint('persist', 'writers')
+attempts = conf.getint('persist', 'attempts')
+columns = conf.get('persist', 'columns').split(',')
+# 几何列转换与表结构管理仅支持PostgreSQL, MySQL按原列类型写入WKT文本
+geometry = conf.get('persist', 'geometry').split(',') if serialize_db == 'postgresql' else []
+# 重新采集并更新的行同时刷新 last_seen, 该列由 python Persist.py schema 创建(仅PostgreSQL)
+seen_column = 'last_seen' if serialize_db == 'postgresql' else None
+
+
+def get_db():
+    return DBManager(conf.get(serialize_db, 'host'), db=conf.get(serialize_db, 'database'),
+                     user=conf.get(serialize_db, 'username'), password=conf.get(serialize_db, 'password'),
+                     dbtype=serialize_db)
+
+
+def get_redis():
+    return redis.Redis(host=conf.get('redis', 'host'), password=conf.get('redis', 'password'))
+
+
+class Writer(threading.Thread):
+    """
+    写入线程: 按uid哈希分区, 同一uid总由同一线程写入, 攒够 batch_size 或超过 flush_interval 时批量upsert,
+    提交或转入死信队列后才从处理中列表确认
+    """
+
+    def __init__(self, r, task_queue, index):
+        super().__init__(name='writer-%d' % index, daemon=True)
+        self.r = r
+        self.task_queue = task_queue
+        self.detector = ChangeDetector(r, fingerprint_db, seen_db)
+        # 有界队列, 写入跟不上时阻塞读取
+        self.queue = queue.Queue(batch_size * 2)
+
+    def put(self, item):
+        # 线程已退出时不再阻塞等待, 由主循环终止进程, 未确认的结果在重启后重放
+        while True:
+            try:
+                self.queue.put(item, timeout=flush_interval)
+                return
+            except queue.Full:
+                if not self.is_alive():
+                    raise RuntimeError("持久化: 写入线程 %s 已退出" % self.name)
+
+    def flush(self, db, items):
+        raws = [raw for raw, row in items]
+        for attempt in range(attempts):
+            try:
+                db.upsert_many([row for raw, row in items], db_obj, 'uid', columns, geometry, seen_column)
+                # 刷新模式的指纹在提交后写入, 未入库的POI下次刷新仍视为变化
+                self.detector.commit(fingerprints(items))
+                self.task_queue.ack_many(raws)
+                return
+            except Exception:
+                logger.exception("持久化: %s 批量写入失败 %d/%d" % (self.name, attempt + 1, attempts))
+                time.sleep(2 ** attempt)
+        # 多次失败的批次转入死信队列, 可用 python Persist.py retry 重新入队
+        self.r.rpush(db_dead, *raws)
+        self.task_queue.ack_many(raws)
+
+    def run(self):
+        db, items, deadline = None, [], None
+        while True:
+            try:
+                items.append(self.queue.get(timeout=max(deadline - time.time(), 0) if deadline else flush_interval))
+                deadline = deadline or time.time() + flush_interval
+            except queue.Empty:
+                pass
+            if items and (len(items) >= batch_size or time.time() >= deadline):
+                try:
+                    db = db or get_db()
+                    self.flush(db, items)
+                    items, deadline = [], None
+                except Exception:
+                    # 数据库与redis均不可用时保留本批稍后重试, 线程不退出
+                    logger.exception("持久化: %s 写入与死信队列均失败,等待重试" % self.name)
+                    time.sleep(flush_interval)
+
+
+class AsyncWriter(object):
+    """
+    Writer的asyncio版本: 各分区协程共享asyncpg连接池, 多个批次同时在途, 主循环不等待提交即可读取下一批
+    """
+
+    def __init__(self, r, db, task_queue, index):
+        self.r = r
+        self.db = db
+        self.task_queue = task_queue
+        self.detector = AsyncChangeDetector(r, fingerprint_db, seen_db)
+        self.name = 'writer-%d' % index
+        self.queue = asyncio.Queue(batch_size * 2)
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def put(self, item):
+        while True:
+            try:
+                await asyncio.wait_for(self.queue.put(item), flush_interval)
+                return
+            except asyncio.TimeoutError:
+                if self.task.done():
+                    self.task.result()
+                    raise RuntimeError("持久化: 写入协程 %s 已退出" % self.name)
+
+    async def flush(self, items):
+        raws = [raw for raw, row in items]
+        for attempt in range(attempts):
+            try:
+                await self.db.upsert_many([row for raw, row in items], db_obj, 'uid', columns, geometry, seen_column)
+                await self.detector.commit(fingerprints(items))
+                await self.task_queue.ack_many(raws)
+                return
+            except Exception:
+                logger.exception("持久化: %s 批量写入失败 %d/%d" % (self.name, attempt + 1, attempts))
+                await asyncio.sleep(2 ** attempt)
+        await self.r.rpush(db_dead, *raws)
+        await self.task_queue.ack_many(raws)
+
+    async def run(self):
+        items, deadline = [], None
+        while True:
+            try:
+                timeout = max(deadline - time.time(), 0) if deadline else flush_interval
+                items.append(await asyncio.wait_for(self.queue.get(), timeout))
+                deadline = deadline or time.time() + flush_interval
+            except asyncio.TimeoutError:
+                pass
+            if items and (len(items) >= batch_size or time.time() >= deadline):
+                try:
+                    await self.flush(items)
+                    items, deadline = [], None
+                except Exception:
+                    logger.exception("持久化: %s 写入与死信队列均失败,等待重试" % self.name)
+                    await asyncio.sleep(flush_interval)
+
+
+def parse_row(raw):
+    """
+    :return: 结果dict, 无法解析时返回None
+    """
+    try:
+        row = json.loads(raw)
+        row['uid']
+        return row
+    except Exception:
+        logger.warning("持久化: 无法解析的结果转入死信队列")
+
+
+def fingerprints(items):
+    return {row['uid']: row['fingerprint'] for raw, row in items if row.get('fingerprint')}
+
 
+def retry_dead(r):
+    """
+    死信队列移回结果队列
+    """
+    n = 0
+    while r.lmove(db_dead, db_src, 'LEFT', 'RIGHT'):
+        n += 1
+    print("%d rows moved from %s to %s" % (n, db_dead, db_src))
 
-def persist():
-    rs = None
-    host = conf.get(serialize_db, 'host')
-    dbname = conf.get(serialize_db, 'database')
-    user = conf.get(serialize_db, 'username')
-    password = conf.get(serialize_db, 'password')
-    db = DBManager(host, db=dbname, user=user, password=password, dbtype='postgresql')
 
-    pool = redis.ConnectionPool(host=conf.get('redis', 'host'),password=conf.get('redis','password'))
-    r = redis.Redis(connection_pool=pool)
-    db_src = conf.get('redis', 'result_db')
-    db_obj = conf.get(serialize_db, 'table')
+def get_task_queue(r, mode, index, queue_class=TaskQueue):
+    """
+    结果移入按 主机+方式+实例序号 固定的处理中列表, 提交后才移除, 同一实例重启时重放未提交的结果
+    :param mode: sync / async, 同一主机的两种方式互不影响
+    :param index: 实例序号, 同一主机同一方式启动多个进程时各不相同
+    """
+    worker_id = 'persist:%s:%s:%d' % (socket.gethostname(), mode, index)
+    return queue_class(r, db_src, worker_id, conf.getint('queue', 'lease_timeout'), conf.getint('queue', 'reap_interval'))
+
+
+def persist(index=0):
+    r = get_redis()
+    db = get_db()
+    # 表结构未迁移时几何列会写入文本, 缺少唯一索引时每批都会失败, 启动时直接报错
+    db.check_poi_schema(db_obj, 'uid', geometry, seen_column)
+    task_queue = get_task_queue(r, 'sync', index)
+    # 读取在写入线程繁忙时阻塞, 由心跳续约
+    task_queue.start_heartbeat()
+    n = task_queue.requeue()
+    if n:
+        logger.warning("持久化: 上次未提交的 %d 条结果重新入队" % n)
+    threads = [Writer(r, task_queue, i) for i in range(writers)]
+    for thread in threads:
+        thread.start()
 
     while True:
-        if r.llen(db_src) > 0:
+        # 刷新模式下未变化的uid批量更新last_seen
+        seen = r.lpop(seen_db, batch_size)
+        if seen:
             try:
-                rs = r.lpop(db_src).decode()
-                d = json.loads(rs)
-                ret = db.delete_and_insert('uid', d, db_obj)
-            except Exception as e:
-                print('Persist Excetion')
-                r.lpush(db_obj, rs)
-        else:
-            del db
-            time.sleep(300)
-            db = DBManager(host, db=dbname, user=user, password=password, dbtype='postgresql')
+                db.touch('uid', [uid.decode() for uid in seen], db_obj)
+            except Exception:
+                logger.exception("持久化: last_seen 更新失败")
+                r.rpush(seen_db, *seen)
+
+        # 回收其他主机上失效的持久化进程未提交的结果
+        task_queue.reap()
+        # 阻塞等待首条结果, 再批量移入处理中列表
+        for raw in task_queue.get_many(batch_size, int(flush_interval) or 1):
+            row = parse_row(raw)
+            if row is None:
+                r.rpush(db_dead, raw)
+                task_queue.ack(raw)
+                continue
+            threads[zlib.crc32(row['uid'].encode('utf8')) % writers].put((raw, row))
+
+
+async def persist_async(index=0):
+    r = aioredis.Redis(host=conf.get('redis', 'host'), password=conf.get('redis', 'password'))
+    # 每个分区最多占用一个连接, 另留一个给last_seen更新
+    db = await AsyncDBManager(conf.get(serialize_db, 'host'), db=conf.get(serialize_db, 'database'),
+                              user=conf.get(serialize_db, 'username'), password=conf.get(serialize_db, 'password'),
+                              max_size=writers + 1).connect()
+    await db.check_poi_schema(db_obj, 'uid', geometry, seen_column)
+    task_queue = get_task_queue(r, 'async', index, AsyncTaskQueue)
+    task_queue.start_heartbeat()
+    n = await task_queue.requeue()
+    if n:
+        logger.warning("持久化: 上次未提交的 %d 条结果重新入队" % n)
+    partitions = [AsyncWriter(r, db, task_queue, i) for i in range(writers)]
+    for partition in partitions:
+        partition.start()
+
+    while True:
+        seen = await r.lpop(seen_db, batch_size)
+        if seen:
+            try:
+                await db.touch('uid', [uid.decode() for uid in seen], db_obj)
+            except Exception:
+                logger.exception("持久化: last_seen 更新失败")
+                await r.rpush(seen_db, *seen)
+
+        await task_queue.reap()
+        for raw in await task_queue.get_many(batch_size, int(flush_interval) or 1):
+            row = parse_row(raw)
+            if row is None:
+                await r.rpush(db_dead, raw)
+                await task_queue.ack(raw)
+                continue
+            await partitions[zlib.crc32(row['uid'].encode('utf8')) % writers].put((raw, row))
 
 
 if __name__ == '__main__':
-    persist()
+    # python Persist.py [retry|schema|async] [实例序号]
+    args = sys.argv[1:]
+    instance = int(args.pop()) if args and args[-1].isdigit() else 0
+    command = args[0] if args else None
+    if command == 'retry':
+        retry_dead(get_redis())
+    elif command == 'schema':
+        get_db().create_poi_schema(db_obj)
+    elif command == 'async':
+        # 仅支持PostgreSQL
+        asyncio.run(persist_async(instance))
+    else:
+        persist(instance)
@@ -1,38 +1,43 @@
 import redis
 import sys, os
 from configparser import ConfigParser
-from utils.geohash import GeohashOperator
-from shapely.geometry import MultiPolygon
+from utils.TilePlanCache import TilePlanCache
 
 conf = ConfigParser()
 conf.read("spider.conf", encoding='utf-8')
 
 r = redis.Redis(host=conf.get('redis', 'host'),password=conf.get('redis','password'))
-geo = GeohashOperator()
 len_geohash = int(conf.get('common','geohash_length'))
+merge_flag = conf.get('common', 'merge_keywords') == 'true'
+merge_size = conf.getint('common', 'merge_size')
 
 
-def push_task(region, query):
-    r.rpush(conf.get('redis', 'task_db'), region + '#' + query)
+def plan_queries(query):
+    """
+    合并检索模式下, 逗号分隔的关键字中大类名展开为小类, 每 merge_size 个以$合并为一个检索词
+    :return: 检索词列表, 未开启合并时为原关键字
+    """
+    if not merge_flag:
+        return [query]
+    keywords = []
+    for keyword in query.split(','):
+        items = conf.get('category', keyword).split(',') if conf.has_option('category', keyword) else [keyword]
+        for item in items:
+            if item not in keywords:
+                keywords.append(item)
+    return ['$'.join(keywords[i:i + merge_size]) for i in range(0, len(keywords), merge_size)]
 
 
-def parse_city_to_sample_points(city, city_df):
-    polygon = city_df.loc[city, 'aoi']
-    if not polygon:
+def push_task(region, queries):
+    r.rpush(conf.get('redis', 'task_db'), *[region + '#' + query for query in queries])
+
+
+def parse_city_to_sample_points(city, tiles):
+    if city not in tiles.cities:
         print(F"{city} 不存在,请检查名称")
         exit(-1)
-    if isinstance(polygon , MultiPolygon):
-        geohashes = []
-        for poly in polygon:
-            geohashes.extend(geo.polygon_geohasher(poly, len_geohash,len_geohash, True))
-    else:
-        geohashes = geo.polygon_geohasher(polygon, len_geohash,len_geohash ,True)
-
-    geohash_polygon = [geo.geohash_to_polygon(geohash, False)[:4:2] for geohash in geohashes]
-    geohash_box_str = [','.join(map(str, left_down[::-1])) + "," + ','.join(map(str, right_top[::-1])) for
-                       left_down, right_top in
-                       geohash_polygon]
-    return geohash_box_str
+    geohashes, boxes = tiles.plan(city)
+    return tiles.box_strings(boxes)
 
 
 if __name__ == '__main__':
@@ -41,6 +46,7 @@ if __name__ == '__main__':
         exit(0)
 
     region, query = sys.argv[1], sys.argv[2]
+    queries = plan_queries(query)
 
     mode = conf.get('common', 'mode')
     assert mode in ('city', 'grid')
@@ -49,45 +55,38 @@ if __name__ == '__main__':
         if region == '全国':
             citys = list(zip(*conf.items('city')))[0]
             for city in citys:
-                push_task(city, query)
+                push_task(city, queries)
                 print("push %s region to queue : %s" % (city, query))
         else:
-            push_task(region, query)
+            push_task(region, queries)
             print("push %s region to queue : %s" % (region, query))
     # 栅格检索模式
     else:
         city_file = conf.get("common", "city_file")
         if city_file and os.path.exists(city_file) and os.path.isfile(city_file):
-            import pandas as pd
-            from shapely.wkt import loads
-
-            city_df = pd.read_csv(city_file, sep=":", names=['label', 'aoi'])
-            city_df['aoi'] = city_df['aoi'].map(lambda x: loads(x))
-            city_df['city'] = city_df['label'].map(lambda x: x.split("|")[0].split("_")[1])
-            city_df['prov'] = city_df['label'].map(lambda x: x.split("|")[0].split("_")[0])
-            prov_city_dict = city_df[['prov', 'city']].groupby("prov").apply(lambda x: x['city'].to_list()).to_dict()
-            city_df.set_index('city', inplace=True)
+            tiles = TilePlanCache(city_file, conf.get('common', 'tile_cache_dir'), len_geohash)
+            prov_city_dict = tiles.provinces()
 
             if region == '全国':
                 citys = list(zip(*conf.items('city')))[0]
                 for city in citys:
-                    city_sample_points = parse_city_to_sample_points(city, city_df)
+                    city_sample_points = parse_city_to_sample_points(city, tiles)
                     for city_sample_point in city_sample_points:
-                        push_task(city_sample_point, query)
+                        push_task(city_sample_point, queries)
                     print("push %s region to queue : %s" % (city, query))
             else:
                 if region in prov_city_dict:
                     print(region)
                     for city in prov_city_dict[region]:
                         print("  +++" , city)
-                        city_sample_points = parse_city_to_sample_points(city, city_df)
+                        city_sample_points = parse_city_to_sample_points(city, tiles)
                         for city_sample_point in city_sample_points:
-                            push_task(city_sample_point, query)
+                            push_task(city_sample_point, queries)
                 else:
                     print(region)
-                    city_sample_points = parse_city_to_sample_points(region, city_df)
+                    city_sample_points = parse_city_to_sample_points(region, tiles)
                     for city_sample_point in city_sample_points:
-                        push_task(city_sample_point, query)
+                        push_task(city_sample_point, queries)
                 print("push %s region to queue : %s" % (region, query))
         else:
             print("spider.conf=>[common] city_file 存在错误")
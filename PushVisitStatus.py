@@ -1,28 +1,113 @@
+import sys
+import json
 import redis
-import pandas as pd
 from sqlalchemy.engine import create_engine
 from configparser import ConfigParser
 from utils.DBManager import DBManager
+from utils.VisitedSet import get_visited_set
 
 # 加载配置
 conf = ConfigParser()
 conf.read("spider.conf", encoding='utf-8')
 
 serialize_db = conf.get('common', 'serialize_db')
-visit_db = conf.get("redis", "visit_db")
 redis_host = conf.get("redis", "host")
 host = conf.get(serialize_db, "host")
 dbname = conf.get(serialize_db, "database")
 user = conf.get(serialize_db, "username")
 password = conf.get(serialize_db, "password")
+table = conf.get(serialize_db, "table")
+overlap = conf.getint("redis", "visit_sync_overlap")
+# 已推送但尚未入库的结果所在队列, 死信队列中的结果不计入, 以便重新采集
+pending_dbs = [conf.get("redis", "result_db"), conf.get("redis", "enrich_db")]
 r = redis.Redis(redis_host, port=6379)
+visited = get_visited_set(r, conf)
 db = DBManager(host, db=dbname, user=user, password=password, dbtype='postgresql')
-engine = db.engine
+# 上次同步开始时的数据库时间戳(秒)
+watermark_db = visited.visit_db + ':watermark'
 
-visited_uid = pd.read_sql("select uid from poi", engine, chunksize=10000)
 
-r.delete(visit_db)
+def db_now():
+    return float(db.query_df("SELECT extract(epoch FROM now()) AS ts")['ts'][0])
 
-for batch in visited_uid:
-    r.sadd(visit_db, *batch['uid'].to_list())
-print("{} uid push to {} set from redis".format(serialize_db, visit_db))
+
+def sync(key, where=None, params=None):
+    """
+    服务端游标分批读取uid写入 key
+    :return: uid数量
+    """
+    n = 0
+    for batch in db.stream(table, ['uid'], where=where, params=params, batch_size=10000):
+        visited.add_many(batch['uid'].tolist(), key=key)
+        n += len(batch['uid'])
+    return n
+
+
+def sync_pending(key, chunk=10000):
+    """
+    结果队列、补充队列及其处理中列表中尚未入库的uid写入 key
+    :return: uid数量
+    """
+    names = list(pending_dbs)
+    for name in pending_dbs:
+        names.extend(processing.decode() for processing in r.scan_iter(name + ':processing:*'))
+    n = 0
+    # 先扫描队列再扫描处理中列表, 扫描期间被取走的结果在处理中列表或已入库
+    for name in names:
+        start = 0
+        while True:
+            items = r.lrange(name, start, start + chunk - 1)
+            if not items:
+                break
+            uids = []
+            for item in items:
+                try:
+                    uids.append(json.loads(item)['uid'])
+                except Exception:
+                    continue
+            visited.add_many(uids, key=key)
+            n += len(uids)
+            start += chunk
+    return n
+
+
+def full_sync():
+    """
+    全量同步: 写入临时key后RENAME原子替换, 同步期间爬虫仍使用旧集合;
+    已删除或转入死信队列的uid不再视为已访问, 尚未入库的uid及同步期间入库的uid一并写入
+    """
+    start = db_now()
+    tmp = visited.visit_db + ':sync'
+    r.delete(tmp)
+    n = sync(tmp)
+    sync_pending(tmp)
+    # 扫描队列期间提交的结果已离开队列, 从同步开始的水位再补一次
+    sync(tmp, "last_seen >= to_timestamp(%s)", (start - overlap,))
+    if r.exists(tmp):
+        r.rename(tmp, visited.visit_db)
+    else:
+        r.delete(visited.visit_db)
+    r.set(watermark_db, start)
+    return n
+
+
+def incremental_sync():
+    """
+    增量同步: 只加载 last_seen 不早于上次水位的uid, 无水位时退化为全量同步
+    """
+    watermark = r.get(watermark_db)
+    if watermark is None:
+        return full_sync()
+    start = db_now()
+    n = sync(visited.visit_db, "last_seen >= to_timestamp(%s)", (float(watermark) - overlap,))
+    r.set(watermark_db, start)
+    return n
+
+
+if __name__ == '__main__':
+    # python PushVisitStatus.py [full|incremental]
+    if len(sys.argv) > 1 and sys.argv[1] == 'incremental':
+        count = incremental_sync()
+    else:
+        count = full_sync()
+    print("{} {} uid push to {} set from redis".format(serialize_db, count, visited.visit_db))
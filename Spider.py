@@ -1,13 +1,21 @@
 import geohash
 import math
+import numpy as np
 import json
 import redis
-import requests
 import time
 import logging
+from collections import namedtuple
 from shapely.geometry import Polygon
 from configparser import ConfigParser
 from utils.GisTransformer import GisTransformer
+from utils.HttpClient import HttpClient, ProxyPool
+from utils.RetryScheduler import RetryScheduler, CircuitBreaker, CircuitOpenError
+from utils.TaskQueue import TaskQueue
+from utils.ChangeDetector import ChangeDetector
+from utils.AKLimiter import AKLimiter, NoAKError
+from utils.VisitedSet import get_visited_set
+from utils.ResponseCache import ResponseCache
 from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 # 加载配置
@@ -50,6 +58,34 @@ gis = GisTransformer('bd09', 'wgs84')
 
 proxy_flag = conf.get('common', 'proxy') == 'true'
 update_flag = conf.get('common', 'update') == 'true'
+# 刷新模式: 仅新增或变化的POI补充与入库
+refresh_flag = conf.get('common', 'refresh') == 'true'
+# 两阶段模式: 检索只推送基础POI, AOI与详情由Enrich.py补充
+enrich_flag = conf.get('common', 'enrich_stage') == 'true'
+
+# 超限区域拆分: 子区域期望POI数、最小边长(度)、最大拆分深度
+split_target = conf.getint('common', 'split_target')
+min_tile_size = conf.getfloat('common', 'min_tile_size')
+max_split_depth = conf.getint('common', 'max_split_depth')
+
+# 按上游主机与按代理的熔断器
+upstream_breaker = CircuitBreaker(conf.getint('breaker', 'upstream_threshold'), conf.getint('breaker', 'window'),
+                                  conf.getint('breaker', 'cooldown'))
+proxy_breaker = CircuitBreaker(conf.getint('breaker', 'proxy_threshold'), conf.getint('breaker', 'window'),
+                               conf.getint('breaker', 'cooldown'))
+# 本地代理池与按主机复用的长连接
+proxy_pool = ProxyPool(conf.get('proxy', 'host'),
+                       prefetch=conf.getint('proxy', 'prefetch'),
+                       min_size=conf.getint('proxy', 'min_size'),
+                       min_success_rate=conf.getfloat('proxy', 'min_success_rate'),
+                       breaker=proxy_breaker) if proxy_flag else None
+# 每主机保留的长连接数覆盖检索分页与Enrich.py补充阶段的并发线程数, 避免超出的连接被丢弃
+http_client = HttpClient(headers, proxy_pool, pool_maxsize=max(conf.getint('common', 'page_concurrency'),
+                                                                conf.getint('common', 'enrich_concurrency')),
+                         breaker=upstream_breaker)
+# AOI与详情响应缓存
+response_cache = ResponseCache(conf.get('cache', 'path'), conf.getint('cache', 'ttl'),
+                               conf.getint('cache', 'max_size')) if conf.get('cache', 'enable') == 'true' else None
 
 class Spider(object):
     """
@@ -63,56 +99,59 @@ class Spider(object):
         self.__visit_db = conf.get('redis', 'visit_db')
         self.__ak_db = conf.get('redis', 'ak_db')
         self.__result_db = conf.get('redis', 'result_db')
+        self.__enrich_db = conf.get('redis', 'enrich_db')
+        self.__visited = get_visited_set(self.__r, conf)
+        self.__detector = ChangeDetector(self.__r, conf.get('redis', 'fingerprint_db'), conf.get('redis', 'seen_db'))
+        self.__ak_limiter = AKLimiter(self.__r, self.__ak_db, conf.getint('ak', 'qps'),
+                                      conf.getint('ak', 'daily_quota'), conf.getint('ak', 'lease_timeout'))
+        self.__retry = RetryScheduler(self.__r, self.__task_db, conf.get('redis', 'delay_db'),
+                                      conf.get('redis', 'dead_db'), conf.getint('retry', 'max_attempts'),
+                                      conf.getint('retry', 'base_delay'), conf.getint('retry', 'max_delay'))
+        self.__queue = TaskQueue(self.__r, self.__task_db, lease_timeout=conf.getint('queue', 'lease_timeout'),
+                                 reap_interval=conf.getint('queue', 'reap_interval'))
+        self.__block_timeout = conf.getint('queue', 'block_timeout')
 
         self.__mode = conf.get('common', 'mode')  # grid / city
+        # 同一区域多页结果并发请求
+        self.__executor = ThreadPoolExecutor(conf.getint('common', 'page_concurrency'))
 
     def __get_ak(self):
-        # 获得一个随机AK
-        ak = self.__r.srandmember(self.__ak_db, 1)
-        if ak:
-            ak = ak[0].decode("utf8")
-            return ak
+        # 租用余量最大的AK, 所有AK令牌不足时阻塞等待
+        return self.__ak_limiter.lease()
 
     def __is_empty_ak(self):
-        return self.__r.scard(self.__ak_db) == 0
+        # 集合中的AK可能当日额度已用尽, 按额度余量判断
+        return self.__ak_limiter.available() == 0
 
-    def __is_empty_task(self):
-        return self.__r.llen(self.__task_db) == 0
+    def __reset_task(self, keyword, region, **state):
+        self.__r.lpush(self.__task_db, dump_task(region, keyword, **state))
 
-    def __get_task(self):
-        if not self.__is_empty_task():
-            return self.__r.lpop(self.__task_db).decode('utf8')
+    def __retry_task(self, keyword, region, count=True, **state):
+        """
+        失败任务进入延迟队列, 不阻塞当前worker
+        :param count: 是否计入失败次数, AK限流、熔断等与任务本身无关的失败不计入
+        """
+        if count:
+            state['attempt'] = state.get('attempt', 0) + 1
+        if not self.__retry.schedule(dump_task(region, keyword, **state), state.get('attempt', 0)):
+            logger.error("uid采集器: 任务失败%d次,转入死信队列 %s" % (state['attempt'], region))
 
-    def __reset_task(self, keyword, region, mode='l'):
-        if mode == 'l':
-            self.__r.lpush(self.__task_db, region + '#' + keyword)
-        else:
-            self.__r.rpush(self.__task_db, region + '#' + keyword)
+    def __push_tasks(self, tasks):
+        # 子任务推送到队列前端, 任意worker均可领取
+        if tasks:
+            self.__r.lpush(self.__task_db, *tasks)
 
     def __remove_ak(self, ak):
-        self.__r.srem(self.__ak_db, ak)
+        if ak:
+            self.__r.srem(self.__ak_db, ak)
 
-    def __is_visited(self, uid):
-        if self.__r.sismember(self.__visit_db, uid):
-            return True
-        else:
-            return False
-
-    def __set_visited(self, uid):
-        # 设置已访问
-        if not self.__r.sismember(self.__visit_db, uid):
-            self.__r.sadd(self.__visit_db, uid)
-            return True
-        else:
-            return False
+    def __is_visited(self, uids):
+        # 一次查询整页uid
+        return self.__visited.contains_many(uids)
 
     @staticmethod
     def __request_url(url):
-        if proxy_flag:
-            proxy = requests.get('http://10.126.138.150:5010/get').text
-            return requests.get(url, headers=headers, proxies={"https": proxy}).json()
-        else:
-            return requests.get(url, headers=headers).json()
+        return http_client.get_json(url)
 
     @staticmethod
     def get_aoi(uid):
@@ -121,262 +160,435 @@ class Spider(object):
         :param uid:
         :return:  AOI列表
         """
-        content = Spider.__request_url(aoi_str % uid).get(
-            'content').get('geo')
+        content = response_cache.get('aoi', uid) if response_cache else None
+        if content is None:
+            content = Spider.__request_url(aoi_str % uid).get(
+                'content').get('geo') or ''
+            if response_cache:
+                response_cache.set('aoi', uid, content)
         if content:
-            wgs84_aois = []
-            aois, bound = gis.parseGeo(content)  # 解析墨卡托坐标系
-            # 围栏  坐标系转换:墨卡托-->百度-->wgs84
-            for mocator in aois:
-                bd_coord_aois = [list(gis.transform_func(*gis.convert_MCT_2_BD09(mct_x, mct_y))) for
-                                 mct_x, mct_y in
-                                 mocator]
-                bd_coord_aois = [[round(lon, 6), round(lat, 6)] for lon, lat in bd_coord_aois]
-                wgs84_aois.append(bd_coord_aois)
-
-            if len(wgs84_aois) == 1:
-                # 几乎100%是只有一个aoi,所以无需再套一层列表
-                final_polygon = wgs84_aois[0]
-            else:
-                final_polygon = Polygon(wgs84_aois[0])
-                for wgs84_aoi in wgs84_aois[1:]:
-                    cur_polygon = Polygon(wgs84_aoi)
-                    if cur_polygon.intersects(final_polygon):
-                        final_polygon = final_polygon.difference(cur_polygon)
-                    else:
-                        final_polygon = final_polygon.union(cur_polygon)
-
-            return Polygon(final_polygon).wkt
+            return aoi_to_wkt(content)
         return
 
-    def __fix_tag(self, tag):
-        if len(tag.split(";")) == 1:
-            return (category.get(tag, '') + ';' + tag).strip(';')
-        return tag
+    def __get_detail(self, uid):
+        content = response_cache.get('detail', uid) if response_cache else None
+        if content is None:
+            ak = self.__get_ak()
+            if not ak:
+                return None
+            content = self.__request_url(detail_str.format(uid=uid, ak=ak))['result']
+            if response_cache:
+                response_cache.set('detail', uid, content)
+        return content
 
     def __get_attribute(self, uid):
-        ak = self.__get_ak()
-        attribute = ""
-        if ak:
-            url = detail_str.format(uid=uid, ak=ak)
-            content = self.__request_url(url)['result']
-            if isinstance(content.get('detail_info', 0), dict):
-                content = content.get('detail_info')
-                tag = content.get('tag', 0)
-                if '旅游景点' in tag:
-                    attribute = content.get('scope_grade', '')
-                elif '医疗' in tag or '高等院校' in tag:
-                    attribute = content.get('content_tag', '')
-        return attribute
-
-    def __push_result(self, result):
-        if self.__set_visited(result['uid']):
-            return self.__r.rpush(self.__result_db, json.dumps(result))
-
-    def __parse_poi_info(self, uid, content):
-        lon, lat = gis.transform_func(float(content['location']['lng']),
-                                      float(content['location']['lat']))
-        geohash_ = geohash.encode(lat, lon, 8)
-        name = content['name']
+        return parse_attribute(self.__get_detail(uid))
+
+    def __push_results(self, results):
+        # 未访问过的结果标记已访问并推送, 整页一次往返
+        return self.__visited.add_and_push([(result['uid'], json.dumps(result)) for result in results],
+                                           self.__enrich_db if enrich_flag else self.__result_db)
+
+    def __push_changed(self, results, fingerprints):
+        # 刷新模式下已访问的POI同样推送, 指纹随结果推送, 入库后由Persist.py写入
+        if not results:
+            return 0
+        self.__visited.add_many([result['uid'] for result in results])
+        for result in results:
+            result['fingerprint'] = fingerprints[result['uid']]
+        return self.__r.rpush(self.__enrich_db if enrich_flag else self.__result_db,
+                              *[json.dumps(result) for result in results])
+
+    def enrich_poi(self, poi_info):
+        """
+        补充AOI与详情属性
+        :param poi_info: 检索阶段解析的基础POI
+        :return: 补充后的POI
+        """
+        uid = poi_info['uid']
         aoi = self.get_aoi(uid)
-        province = content.get('province', '')
-        area = content.get('city', '')
-        district = content.get('area', '')
-        tag = self.__fix_tag(content.get('detail_info', {}).get('tag', ''))
-        telephone = content.get('telephone', '')
-
-        # 指定的类型需要更相信的信息
-        attribute = self.__get_attribute(uid) if tag and any([i in tag for i in ['医疗', '高等院校', '旅游景点']]) else None
-        poi_info_dict = {
-            'uid': uid,
-            'poi': "POINT ( {} {} )".format(round(lon, 6), round(lat, 6)),
-            'name': name,
-            'geohash': geohash_,
-            'province': province,
-            'area': area,
-            'district': district,
-            'tag': tag,
-            'telephone': telephone
-        }
+        attribute = self.__get_attribute(uid) if needs_attribute(poi_info['tag']) else None
         if aoi:
-            poi_info_dict['aoi'] = aoi
+            poi_info['aoi'] = aoi
         if attribute:
-            poi_info_dict['attribute'] = attribute
-        return poi_info_dict
+            poi_info['attribute'] = attribute
+        return poi_info
+
+    def __parse_poi_info(self, uid, content):
+        poi_info = parse_poi_base(uid, content)
+        # 两阶段模式下AOI与详情由Enrich.py补充
+        return poi_info if enrich_flag else self.enrich_poi(poi_info)
+
+    def __request_page(self, url_format_str, page_num, **params):
+        ak = self.__get_ak()
+        if not ak:
+            # 未租到AK不发出请求, 由调用方延迟重试且不计失败次数
+            raise NoAKError(url_format_str.split('?')[0])
+        url = url_format_str.format(ak=ak, page_num=page_num, **params)
+        return ak, url, self.__request_url(url)
 
-    def claw_by_region(self, keyword, region, page_num, page_nums):
+    def __request_pages(self, url_format_str, pages, **params):
         """
-        行政区划采集器 , 仅支持单关键字检索
-        优点：采集速度快
-        缺点：返回POI数量不全，缺失问题
-        :return:
+        并发请求多页结果, 按页码顺序返回 (page, ak, url, content), 请求异常的页content为异常对象
         """
-        if page_nums and page_num >= page_nums:
-            return
+        futures = [(page, self.__executor.submit(self.__request_page, url_format_str, page, **params))
+                   for page in pages]
+        results = []
+        for page, future in futures:
+            try:
+                results.append((page,) + future.result())
+            except Exception as e:
+                results.append((page, None, None, e))
+        return results
+
+    def __save_results(self, region, results, uid_key, check_visited, refresh=False):
+        """
+        多页结果合并后按uid去重, 批量检查已访问, 解析后批量推送
+        :param refresh: 刷新模式, 按指纹只处理新增或变化的POI
+        """
+        unique = unique_results(results, uid_key)
+        uids = list(unique.keys())
+        fingerprints = {}
+        if refresh:
+            # 未变化的uid只更新last seen, 不再请求AOI与详情
+            fingerprints = fingerprint_results(unique)
+            uids = self.__detector.changed(fingerprints)
+        # 检查是否访问过该目标
+        elif check_visited:
+            uids = [uid for uid, visited in zip(uids, self.__is_visited(uids)) if not visited]
+
+        poi_infos = []
+        for uid in uids:
+            try:
+                poi_infos.append(self.__parse_poi_info(uid, unique[uid]))
+            except Exception:
+                logger.info("uid采集器: 获得结果异常 %s %s" % (region, uid))
+        if refresh:
+            self.__push_changed(poi_infos, fingerprints)
+        else:
+            self.__push_results(poi_infos)
+
+    def __handle_status(self, source, content, ak, keyword, region, **state):
+        action = status_action(source, content, ak)
+        if action == 'reset':
+            self.__remove_ak(ak)  # 删除 队列 ak
+            self.__reset_task(keyword, region, **state)  # 推送该失败box到队列前端, 由其他AK重试
+        elif action == 'dead':
+            self.__retry.dead(dump_task(region, keyword, **state))
+        else:
+            self.__retry_task(keyword, region, count=action == 'retry', **state)
 
-        # 获得一个随机AK
-        ak = self.__get_ak()
+    def __handle_error(self, source, error, keyword, region, **state):
+        if isinstance(error, Exception):
+            self.__retry_task(keyword, region, count=counts_attempt(error), **state)
+        else:
+            self.__handle_status(source, error[0], error[1], keyword, region, **state)
 
-        url_format_str = box_str if region.find(",") >= 0 else region_str
-        url = url_format_str.format(ak=ak, page_num=page_num, query=keyword, region=region)
-
-        # 访问请求
-        try:
-            content = self.__request_url(url)
-        except:
-            self.__reset_task(keyword, region, mode='r')
-            logger.error("Error Code : 001 . 区域检索访问异常: %s " % url)
-            return
-
-        if content['status'] == 0:
-            total = content['total']
-            if total == 0:  # 区域内没有目标
-                logger.info("uid采集器: 区域无采集目标.")
+    def __claw(self, source, url_format_str, params, keyword, region, state, check_visited, refresh=False):
+        """
+        首页返回总数后, 其余页并发请求, 合并去重后推送
+        部分页失败时任务记录总数与已完成页(total, done), 重试只请求未完成的页
+        :param params: 检索URL参数
+        """
+        results = []
+        if 'total' not in state:
+            # 访问请求
+            try:
+                ak, url, content = self.__request_page(url_format_str, 0, **params)
+            except Exception as e:
+                logger.error("Error Code : 001 . 区域检索访问异常: %s " % region)
+                self.__handle_error(source, e, keyword, region, **state)
                 return
-            elif total >= 400:  # 总数超过限制，区域分解递归
-                if region.find(',') >= 0:
-                    logger.warning("uid采集器: POI数量过大,进行递归采集 %s" % url)
-                    min_lat, min_lon, max_lat, max_lon = region.split(',')
-                    left_mid = str((float(min_lat) + float(max_lat)) / 2) + ',' + min_lon
-                    mid_mid = str((float(min_lat) + float(max_lat)) / 2) + ',' + str(
-                        (float(min_lon) + float(max_lon)) / 2)
-                    mid_up = max_lat + ',' + str((float(min_lon) + float(max_lon)) / 2)
-                    mid_down = min_lat + ',' + str((float(min_lon) + float(max_lon)) / 2)
-                    right_mid = str((float(min_lat) + float(max_lat)) / 2) + ',' + max_lon
-                    logger.info("uids: 总数%d, 递归左下区域 %s" % (total, p(min_lat, min_lon, mid_mid)))
-                    self.claw_by_region(p(min_lat, min_lon, mid_mid), keyword, 0, None)
-                    logger.info("uids: 总数%d, 递归左上区域 %s" % (total, p(left_mid, mid_up)))
-                    self.claw_by_region(p(left_mid, mid_up), keyword, 0, None)
-                    logger.info("uids: 总数%d, 递归右上区域 %s" % (total, p(mid_mid, max_lat, max_lon)))
-                    self.claw_by_region(p(mid_mid, max_lat, max_lon), keyword, 0, None)
-                    logger.info("uids: 总数%d, 递归右下区域 %s" % (total, p(mid_down, right_mid)))
-                    self.claw_by_region(p(mid_down, right_mid), keyword, 0, None)
-                else:
-                    logger.warning(F"返回POI数量过多，请使用栅格采集模式 {region}")
-                    # 自动启动滑动窗口采集模式，待改造
+            if content['status'] != 0:
+                self.__handle_status(source, content, ak, keyword, region, **state)
                 return
-            else:
-                page_nums = math.ceil(total / 20.0) if page_nums is None else page_nums
-                logger.info("uid采集器: 总数 %d, 当前页  %d/%d, " % (total, page_num + 1, page_nums))
-                for result in content['results']:
-                    try:
-                        uid = result['uid']
-                        # 检查是否访问过该目标
-                        if not update_flag and self.__is_visited(uid):
-                            continue
-                        poi_info = self.__parse_poi_info(uid, result)
-
-                    except Exception:
-                        logger.info("uid采集器: 获得结果异常 %s" % url)
-                        continue
-                    else:
-                        self.__push_result(poi_info)
-
-                # 请求下一页
-                self.claw_by_region(keyword, region, page_num + 1, page_nums)
-        else:
-            if content['status'] == 302:
-                logger.info("uid采集器: 当前AK额度用尽,等待5s...")
-                self.__remove_ak(ak)  # 删除 队列 ak
-                self.__reset_task(keyword, region)  # 推送该失败box到队列前端
-            elif content['status'] == 210:
-                logger.warning("uid采集器: AK %s IP校验失败,等待5s..." % ak)
-                self.__remove_ak(ak)
-                self.__reset_task(keyword, region)
-            elif content['status'] == 2:
-                logger.warning("uid采集器: url 参数异常,忽略")
-            elif content['status'] == 401:
-                logger.info("uid采集器: 当前AK超过并发限制,等待5s...")
-                self.__reset_task(keyword, region)
-            else:
-                logger.warning("uid采集器: 其他异常 状态码 %d " % content['status'])
-            time.sleep(5)
+            proceed, tasks = plan_total(source, keyword, region, content[source.total], state.get('depth', 0), url)
+            self.__push_tasks(tasks)
+            if not proceed:
+                return
+            results.extend(content[source.results])
+            state.update(total=content[source.total], done=1)
 
-    def claw_gaode_poi(self, keyword, region, page_num, page_nums):
+        pages = self.__request_pages(url_format_str, pending_pages(source, state), **params)
+        page_results, error = collect_pages(source, region, pages, state)
+        # 已成功的页先入库, 失败页按状态码处理, 重试时从检查点继续
+        self.__save_results(region, results + page_results, source.uid_key, check_visited, refresh)
+        if error:
+            self.__handle_error(source, error, keyword, region, **state)
 
-        if page_nums and page_num >= page_nums:
-            return
+    def claw_by_region(self, keyword, region, **state):
+        """
+        行政区划采集器 , 支持以$合并的多关键字检索, 结果按自身tag归类
+        优点：采集速度快
+        缺点：返回POI数量不全，缺失问题
+        :return:
+        """
+        url_format_str = box_str if region.find(",") >= 0 else region_str
+        self.__claw(BAIDU, url_format_str, dict(query=keyword, region=region), keyword, region, state,
+                    not update_flag, refresh_flag)
 
-        # 获得一个随机AK
-        ak = self.__get_ak()
+    def claw_gaode_poi(self, keyword, region, **state):
         tag, query = keyword.split(';') if keyword.find(';') >= 0 else (None, keyword)
-
-        url = gaode_region_poi.format(ak=ak, page_num=page_num, tag=tag, region=region)
-
-        # 访问请求
-        try:
-            content = self.__request_url(url)
-        except:
-            self.__reset_task(keyword, region, mode='r')
-            logger.error("Error Code : 001 . 区域检索访问异常: %s " % url)
-            return
-
-        if content['status'] == 0:
-            count = content['count']
-            if count == 0:  # 区域内没有目标
-                logger.info("uid采集器: 区域无采集目标.")
-                return
-            elif count >= 1000:  # 总数超过限制，区域分解递归
-                logger.warning("uid采集器: POI数量过大,请使用滑动窗口采集模式 %s" % url)
-                # 自动启动滑动窗口采集模式，待改造
-                return
-            else:
-                page_nums = math.ceil(count / 25.0) if page_nums is None else page_nums
-                logger.info("uid采集器: 总数 %d, 当前页  %d/%d, " % (count, page_num + 1, page_nums))
-                for result in content['pois']:
-                    try:
-                        uid = result['id']
-                        # 检查是否访问过该目标
-                        if self.__is_visited(uid):
-                            continue
-                        poi_info = self.__parse_poi_info(uid, result)
-
-                    except Exception:
-                        logger.info("采集器: 解析结果异常 %s" % url)
-                        continue
-                    else:
-                        self.__push_result(poi_info)
-
-                # 请求下一页
-                self.claw_gaode_poi(keyword, region, page_num + 1, page_nums)
-        else:
-            if content['infocode'] == 10003:
-                logger.info("uid采集器: 当前AK额度用尽,等待5s...")
-                self.__remove_ak(ak)  # 删除 队列 ak
-                self.__reset_task(keyword, region)  # 推送该失败box到队列前端
-            elif content['infocode'] == 10005:
-                logger.warning("uid采集器: AK %s IP校验失败,等待5s..." % ak)
-                self.__remove_ak(ak)
-                self.__reset_task(keyword, region)
-            elif content['infocode'] == 10002:
-                logger.warning("uid采集器: url 参数异常,忽略")
-            elif content['infocode'] == 10014:
-                logger.info("uid采集器: 当前AK超过并发限制,等待5s...")
-                self.__reset_task(keyword, region)
-            else:
-                logger.warning("uid采集器: 其他异常 状态码 %d " % content['status'])
-            time.sleep(5)
+        self.__claw(GAODE, gaode_region_poi, dict(tag=tag, region=region), keyword, region, state, True)
 
     def run_spider(self):
+        # 单个任务(多页检索与逐条AOI/详情)可能超过租约时长, 执行期间后台续约
+        self.__queue.start_heartbeat()
         while True:
             if self.__is_empty_ak():
                 logger.info("主程序: AK已用尽,等待600s...")
                 time.sleep(60)
                 continue
-            elif self.__is_empty_task():
-                logger.info("主程序: 任务队列为空,等待600s...")
-                time.sleep(60)
+            # 到期的延迟重试任务移回任务队列, 回收失效worker未完成的任务
+            self.__retry.promote()
+            self.__queue.reap()
+            task = self.__queue.get(self.__block_timeout)
+            if not task:
                 continue
-            task = self.__get_task()
-            if task:
-                region, keyword = task.split('#')
-                self.claw_by_region(keyword, region, 0, None)
+            region, keyword, state = load_task(task)
+            try:
+                self.claw_by_region(keyword, region, **state)
+            except Exception:
+                logger.exception("主程序: 任务执行异常 %s" % task)
+                self.__retry_task(keyword, region, **state)
+            self.__queue.ack(task)
 
 
 def p(*args):
     return ','.join(args)
 
 
+def dump_task(region, keyword, **state):
+    """
+    任务格式 region#keyword[#key=value...], 附加状态为整数:
+    depth 拆分深度, attempt 失败次数, total 结果总数, done 已完成页的位掩码
+    """
+    return '#'.join([region, keyword] + ['%s=%s' % (k, v) for k, v in state.items() if v])
+
+
+def load_task(task):
+    """
+    解析任务, 兼容旧格式 region#keyword
+    :return: region, keyword, state
+    """
+    items = task.split('#')
+    state = {k: int(v) for k, v in (item.split('=', 1) for item in items[2:])}
+    return items[0], items[1], state
+
+
+def split_region(region, total):
+    """
+    按返回总数将矩形区域均分为 n*n 个子区域, n 使每个子区域期望POI数不超过 split_target
+    :param region: min_lat,min_lon,max_lat,max_lon
+    :param total: 区域返回的POI总数
+    :return: 子区域列表, 子区域边长将小于 min_tile_size 时返回空列表
+    """
+    min_lat, min_lon, max_lat, max_lon = map(float, region.split(','))
+    n = max(2, math.ceil(math.sqrt(total / split_target)))
+    # 不拆分到最小边长以下
+    n = min(n, int(min(max_lat - min_lat, max_lon - min_lon) / min_tile_size))
+    if n < 2:
+        return []
+    lat_step = (max_lat - min_lat) / n
+    lon_step = (max_lon - min_lon) / n
+    return [p(*map(str, (min_lat + i * lat_step, min_lon + j * lon_step,
+                         min_lat + (i + 1) * lat_step, min_lon + (j + 1) * lon_step)))
+            for i in range(n) for j in range(n)]
+
+
+# 检索接口差异: 结果字段, 总数字段, uid字段, 每页条数, 可翻页的结果上限, 超限时是否拆分区域, 状态码字段与处理方式
+SearchSource = namedtuple('SearchSource', 'results total uid_key page_size max_results split code status')
+
+# 状态码 -> (处理方式, 日志级别, 日志)
+# reset 删除AK后重新入队由其他AK重试, dead 转入死信队列, free 延迟重试不计失败次数, 其余 retry 延迟重试
+BAIDU_STATUS = {
+    302: ('reset', logging.INFO, "uid采集器: 当前AK额度用尽,任务重新入队"),
+    210: ('reset', logging.WARNING, "uid采集器: AK %(ak)s IP校验失败,任务重新入队"),
+    2: ('dead', logging.WARNING, "uid采集器: url 参数异常,转入死信队列"),
+    401: ('free', logging.INFO, "uid采集器: 当前AK超过并发限制,延迟重试"),
+}
+GAODE_STATUS = {
+    10003: ('reset', logging.INFO, "uid采集器: 当前AK额度用尽,任务重新入队"),
+    10005: ('reset', logging.WARNING, "uid采集器: AK %(ak)s IP校验失败,任务重新入队"),
+    10002: ('dead', logging.WARNING, "uid采集器: url 参数异常,转入死信队列"),
+    10014: ('free', logging.INFO, "uid采集器: 当前AK超过并发限制,延迟重试"),
+}
+BAIDU = SearchSource('results', 'total', 'uid', 20, 400, True, 'status', BAIDU_STATUS)
+GAODE = SearchSource('pois', 'count', 'id', 25, 1000, False, 'infocode', GAODE_STATUS)
+
+
+# 以下为同步与异步采集器共用的决策逻辑, 不发起任何I/O
+
+
+def status_action(source, content, ak):
+    """
+    :param content: 状态异常的响应
+    :return: 处理方式 reset / dead / free / retry
+    """
+    code = content[source.code]
+    action, level, message = source.status.get(
+        code, ('retry', logging.WARNING, "uid采集器: 其他异常 状态码 %(code)s ,延迟重试"))
+    logger.log(level, message % {'ak': ak, 'code': code})
+    return action
+
+
+def counts_attempt(error):
+    # 熔断、无可用AK等与任务本身无关的失败不计入失败次数
+    return not isinstance(error, (CircuitOpenError, NoAKError))
+
+
+def plan_total(source, keyword, region, total, depth, url):
+    """
+    按首页返回的总数决定后续处理
+    :return: (是否继续请求其余页, 需推送到队列前端的子任务)
+    """
+    if total == 0:  # 区域内没有目标
+        logger.info("uid采集器: 区域无采集目标.")
+        return False, []
+    if total < source.max_results:
+        return True, []
+    if not source.split:
+        logger.warning("uid采集器: POI数量过大,请使用滑动窗口采集模式 %s" % url)
+        return False, []
+    if keyword.find('$') >= 0:
+        # 合并检索超限时先拆回单关键字任务, 单关键字仍超限再拆分区域
+        logger.warning("uid采集器: 合并检索POI数量过大,拆分为单关键字任务 %s" % url)
+        return False, [dump_task(region, single, depth=depth) for single in keyword.split('$')]
+    if region.find(',') < 0:
+        logger.warning(F"返回POI数量过多，请使用栅格采集模式 {region}")
+        # 自动启动滑动窗口采集模式，待改造
+        return False, []
+    children = split_region(region, total) if depth < max_split_depth else []
+    if children:
+        logger.warning("uid采集器: POI数量过大,拆分为%d个子区域入队 %s" % (len(children), url))
+        return False, [dump_task(child, keyword, depth=depth + 1) for child in children]
+    logger.warning("uid采集器: 区域已达最小尺寸或最大拆分深度,仅采集前%d条 %s" % (total, url))
+    return True, []
+
+
+def pending_pages(source, state):
+    """
+    :param state: 任务状态, total 结果总数, done 已完成页的位掩码
+    :return: 未完成的页码
+    """
+    page_nums = math.ceil(min(state['total'], source.max_results) / float(source.page_size))
+    pending = [page for page in range(page_nums) if not state.get('done', 0) >> page & 1]
+    logger.info("uid采集器: 总数 %d, 并发请求 %d/%d 页, " % (state['total'], len(pending), page_nums))
+    return pending
+
+
+def collect_pages(source, region, pages, state):
+    """
+    合并各页结果, 成功的页记入 state['done']
+    :param pages: [(page, ak, url, content), ...], 请求异常的页content为异常对象
+    :return: (结果列表, 首个错误), 错误为异常对象或 (响应, AK)
+    """
+    results, error = [], None
+    for page, ak, url, content in pages:
+        if isinstance(content, Exception):
+            logger.error("Error Code : 001 . 区域检索访问异常: %s 第%d页" % (region, page))
+            error = error or content
+        elif content['status'] != 0:
+            error = error or (content, ak)
+        else:
+            results.extend(content[source.results])
+            state['done'] = state.get('done', 0) | 1 << page
+    return results, error
+
+
+def unique_results(results, uid_key):
+    """
+    按uid去重, 保留首次出现的结果
+    """
+    unique = {}
+    for result in results:
+        if uid_key in result:
+            unique.setdefault(result[uid_key], result)
+    return unique
+
+
+def fingerprint_results(unique):
+    return {uid: ChangeDetector.fingerprint(result) for uid, result in unique.items()}
+
+
+def needs_attribute(tag):
+    # 指定的类型需要更详细的信息
+    return bool(tag) and any([i in tag for i in ['医疗', '高等院校', '旅游景点']])
+
+
+def parse_attribute(content):
+    """
+    从详情接口结果中解析景点等级、医院/高校类型
+    """
+    attribute = ""
+    if content:
+        if isinstance(content.get('detail_info', 0), dict):
+            content = content.get('detail_info')
+            tag = content.get('tag', 0)
+            if '旅游景点' in tag:
+                attribute = content.get('scope_grade', '')
+            elif '医疗' in tag or '高等院校' in tag:
+                attribute = content.get('content_tag', '')
+    return attribute
+
+
+def fix_tag(tag):
+    # 只有小类的tag补全大类
+    if len(tag.split(";")) == 1:
+        return (category.get(tag, '') + ';' + tag).strip(';')
+    return tag
+
+
+def parse_poi_base(uid, content):
+    """
+    解析检索结果中的基础字段(坐标、名称、类型、行政区划), 不发起网络请求
+    :param uid:
+    :param content: 检索接口返回的单条结果
+    :return: 基础POI
+    """
+    lon, lat = gis.transform_func(float(content['location']['lng']),
+                                  float(content['location']['lat']))
+    return {
+        'uid': uid,
+        'poi': "POINT ( {} {} )".format(round(lon, 6), round(lat, 6)),
+        'name': content['name'],
+        'geohash': geohash.encode(lat, lon, 8),
+        'province': content.get('province', ''),
+        'area': content.get('city', ''),
+        'district': content.get('area', ''),
+        'tag': fix_tag(content.get('detail_info', {}).get('tag', '')),
+        'telephone': content.get('telephone', '')
+    }
+
+
+def aoi_to_wkt(content):
+    """
+    解析AOI接口返回的墨卡托围栏,转换为wgs84坐标系的WKT
+    :param content: AOI接口返回的geo字段
+    :return: POLYGON WKT
+    """
+    wgs84_aois = []
+    aois, bound = gis.parseGeo_array(content)  # 解析墨卡托坐标系
+    # 围栏  坐标系转换:墨卡托-->百度-->wgs84, 整个围栏一次向量化转换
+    for mocator in aois:
+        bd_coord_aois = gis.transform_array(gis.convert_MCT_2_BD09_array(mocator))
+        wgs84_aois.append(np.round(bd_coord_aois, 6).tolist())
+
+    if len(wgs84_aois) == 1:
+        # 几乎100%是只有一个aoi,所以无需再套一层列表
+        final_polygon = wgs84_aois[0]
+    else:
+        final_polygon = Polygon(wgs84_aois[0])
+        for wgs84_aoi in wgs84_aois[1:]:
+            cur_polygon = Polygon(wgs84_aoi)
+            if cur_polygon.intersects(final_polygon):
+                final_polygon = final_polygon.difference(cur_polygon)
+            else:
+                final_polygon = final_polygon.union(cur_polygon)
+
+    return Polygon(final_polygon).wkt
+
+
 def task():
     spider = Spider()
     spider.run_spider()
@@ -3,27 +3,32 @@ import sys
 import pyhdfs
 import pandas as pd
 import shapely.wkt as wkt
+from typing import Iterator
 from tempfile import TemporaryDirectory
-from sqlalchemy import func
-from sqlalchemy.orm import sessionmaker
-from ubd.dbconnect import postgres
+from configparser import ConfigParser
 from ubd.geofunc import GeohashOperator
-from ubd.dbconnect import POI
+from utils.DBManager import DBManager
 
+conf = ConfigParser()
+conf.read("spider.conf", encoding='utf-8')
+serialize_db = conf.get('common', 'serialize_db')
 
-def get_data(keywords: str) -> pd.DataFrame:
+
+def get_data(keywords: str, batch_size: int = 10000) -> Iterator[pd.DataFrame]:
     """
-    get poi related data from POI table
+    get poi related data from POI table, streamed through a server-side cursor
 
     Parameters
     ----------
     keywords : str
         search for a particular tag
+    batch_size : int
+        rows fetched per batch
 
     Returns
     ----------
-    pd.DataFrame
-        DataFrame read from POI
+    Iterator[pd.DataFrame]
+        DataFrames read from POI, one per batch
 
 
     Warning
@@ -32,40 +37,23 @@ def get_data(keywords: str) -> pd.DataFrame:
 
     See Also
     ----------
-    ubd.dbconnect.postgres : database  connector basing on sqlalchemy
+    utils.DBManager.DBManager.stream : server-side cursor reader
     ubd.geofunc.GeohashOperator : geohash operation class
-    ubd.dbconnect.POI : POI table class
     """
-    db = postgres()
+    db = DBManager(conf.get(serialize_db, 'host'), db=conf.get(serialize_db, 'database'),
+                   user=conf.get(serialize_db, 'username'), password=conf.get(serialize_db, 'password'),
+                   dbtype=serialize_db)
     go = GeohashOperator()
-    Session = sessionmaker(bind=db.engine)
-    session = Session()
-    df_aoi = pd.read_sql(
-        session.query(
-            POI.name,
-            func.ST_AsText(POI.aoi).label('geohash'),
-            POI.province,
-            POI.area,
-            POI.district
-        )
-            .filter(POI.tag.match(f"%{keywords}%"))
-            .filter(POI.aoi.isnot(None))
-            .statement,
-        session.bind)
-    df_poi = pd.read_sql(
-        session.query(
-            POI.name,
-            func.substr(POI.geohash, 1, 7).label('geohash'),
-            POI.province,
-            POI.area,
-            POI.district
-        )
-            .filter(POI.tag.match(f"%{keywords}%"))
-            .filter(POI.aoi.is_(None))
-            .statement,
-        session.bind)
-    df_aoi['geohash'] = df_aoi['geohash'].apply(lambda x: list(go.polygon_geohasher(wkt.loads(x), 3, 7)))
-    return pd.concat([df_aoi.explode('geohash'), df_poi])
+    tb = conf.get(serialize_db, 'table')
+    params = (f"%{keywords}%",)
+    for batch in db.stream(tb, ['name', 'ST_AsText(aoi) AS geohash', 'province', 'area', 'district'],
+                           "tag LIKE %s AND aoi IS NOT NULL", params, batch_size):
+        df_aoi = pd.DataFrame(batch)
+        df_aoi['geohash'] = df_aoi['geohash'].apply(lambda x: list(go.polygon_geohasher(wkt.loads(x), 3, 7)))
+        yield df_aoi.explode('geohash')
+    for batch in db.stream(tb, ['name', 'substr(geohash, 1, 7) AS geohash', 'province', 'area', 'district'],
+                           "tag LIKE %s AND aoi IS NULL", params, batch_size):
+        yield pd.DataFrame(batch)
 
 
 def main(keywords: str, tag_type: str) -> None:
@@ -83,11 +71,11 @@ def main(keywords: str, tag_type: str) -> None:
     ----------
     get_data : get poi related data from POI table
     """
-    res = get_data(keywords)
-
     with TemporaryDirectory() as dirname:
-        # generate txt file
-        res.to_csv(os.path.join(dirname, f'POI码表_{keywords}_每日扫描版.txt'), header=None, index=None, sep=',', mode='w')
+        # generate txt file batch by batch
+        with open(os.path.join(dirname, f'POI码表_{keywords}_每日扫描版.txt'), 'w') as f:
+            for res in get_data(keywords):
+                res.to_csv(f, header=None, index=None, sep=',')
 
         # move txt file into hdfs
         hdfs_path = f'/user/hive/warehouse/poi.db/code_aoi_geohash/tag_type={tag_type}/POI码表_{keywords}_每日扫描版.txt'
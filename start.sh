@@ -72,10 +72,9 @@ all_prov=(
 '新疆维吾尔自治区'
 '天津市'
 )
+# 多个关键字以逗号分隔; [common] merge_keywords = true 时大类展开为小类并以$合并检索
 query="休闲娱乐"
 
-for prov in ${use_prov[@]}
-do
-	python PushRegion.py $prov $query
-done
+# 所有省份与关键字在一个进程内切片并批量推送, 已在队列中的任务跳过; @大类 展开为全部小类
+python Dispatch.py $(IFS=,; echo "${use_prov[*]}") $query
 
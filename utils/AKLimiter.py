@@ -0,0 +1,127 @@
+import time
+import asyncio
+import datetime
+
+# 原子租用AK: 每个AK一个令牌桶限制QPS, 每日计数限制额度, 返回余量最大的AK
+# KEYS: AK集合, 令牌数hash, 上次补充时间hash, 当日用量hash
+# ARGV: qps, 每日额度
+# 返回: {ak, 0} 或 {'', 需等待毫秒数}, 等待-1表示无可用AK
+LEASE_SCRIPT = """
+local aks = redis.call('SMEMBERS', KEYS[1])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local qps = tonumber(ARGV[1])
+local quota = tonumber(ARGV[2])
+local best, best_tokens, best_score = nil, 0, -1
+local wait = -1
+for _, ak in ipairs(aks) do
+    local used = tonumber(redis.call('HGET', KEYS[4], ak) or '0')
+    if used < quota then
+        local tokens = tonumber(redis.call('HGET', KEYS[2], ak) or ARGV[1])
+        local ts = tonumber(redis.call('HGET', KEYS[3], ak) or now)
+        tokens = math.min(qps, tokens + (now - ts) * qps / 1000)
+        if tokens >= 1 then
+            local score = tokens / qps + (quota - used) / quota
+            if score > best_score then
+                best, best_tokens, best_score = ak, tokens, score
+            end
+        else
+            local w = math.ceil((1 - tokens) * 1000 / qps)
+            if wait < 0 or w < wait then
+                wait = w
+            end
+        end
+    end
+end
+if best then
+    redis.call('HSET', KEYS[2], best, tostring(best_tokens - 1))
+    redis.call('HSET', KEYS[3], best, now)
+    redis.call('HINCRBY', KEYS[4], best, 1)
+    redis.call('EXPIRE', KEYS[4], 172800)
+    return {best, 0}
+end
+return {'', wait}
+"""
+
+
+class NoAKError(Exception):
+    """
+    无可用AK或等待令牌超时, 请求未发出
+    """
+
+
+class AKLimiter(object):
+    """
+    AK限流器: 按QPS与每日额度租用AK
+    """
+
+    def __init__(self, r, ak_db, qps, daily_quota, timeout=10):
+        """
+        :param r: redis连接
+        :param ak_db: AK集合
+        :param qps: 单个AK每秒请求上限
+        :param daily_quota: 单个AK每日请求上限
+        :param timeout: 所有AK均无令牌时最长等待秒数
+        """
+        self.r = r
+        self.ak_db = ak_db
+        self.qps = qps
+        self.daily_quota = daily_quota
+        self.timeout = timeout
+        self._lease = r.register_script(LEASE_SCRIPT)
+
+    def _keys(self):
+        today = datetime.date.today().strftime('%Y%m%d')
+        return [self.ak_db, self.ak_db + ':tokens', self.ak_db + ':ts', self.ak_db + ':used:' + today]
+
+    def lease(self):
+        """
+        租用一个AK, 全部AK令牌不足时阻塞等待
+        :return: AK, 无可用AK或等待超时返回None
+        """
+        deadline = time.time() + self.timeout
+        while True:
+            ak, wait = self._lease(keys=self._keys(), args=[self.qps, self.daily_quota])
+            if ak:
+                return ak.decode('utf8')
+            if wait < 0 or time.time() + wait / 1000.0 > deadline:
+                return None
+            time.sleep(wait / 1000.0)
+
+    def available(self):
+        """
+        当日额度未用尽的AK数
+        """
+        aks = list(self.r.smembers(self.ak_db))
+        used = self.r.hmget(self._keys()[3], aks) if aks else []
+        return sum(1 for n in used if int(n or 0) < self.daily_quota)
+
+    def usage(self):
+        """
+        当日各AK用量
+        """
+        return {ak.decode('utf8'): int(used) for ak, used in self.r.hgetall(self._keys()[3]).items()}
+
+
+class AsyncAKLimiter(AKLimiter):
+    """
+    AKLimiter的asyncio版本, 需传入redis.asyncio连接
+    """
+
+    async def lease(self):
+        deadline = time.time() + self.timeout
+        while True:
+            ak, wait = await self._lease(keys=self._keys(), args=[self.qps, self.daily_quota])
+            if ak:
+                return ak.decode('utf8')
+            if wait < 0 or time.time() + wait / 1000.0 > deadline:
+                return None
+            await asyncio.sleep(wait / 1000.0)
+
+    async def available(self):
+        aks = list(await self.r.smembers(self.ak_db))
+        used = await self.r.hmget(self._keys()[3], aks) if aks else []
+        return sum(1 for n in used if int(n or 0) < self.daily_quota)
+
+    async def usage(self):
+        return {ak.decode('utf8'): int(used) for ak, used in (await self.r.hgetall(self._keys()[3])).items()}
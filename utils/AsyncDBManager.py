@@ -0,0 +1,162 @@
+import math
+import asyncpg
+import pandas as pd
+from utils.DBManager import DBManager, UNIQUE_INDEX_SQL
+
+
+class AsyncDBManager(object):
+    """
+    DBManager的asyncio版本(仅PostgreSQL), 基于asyncpg连接池, 语句自动预编译并按连接缓存
+    SQL占位符为 $1, $2 ...
+    """
+    # 几何列坐标系 WGS84
+    srid = 4326
+
+    def __init__(self, host, db=None, user=None, password=None, min_size=2, max_size=20):
+        self.host = host
+        self.db = db
+        self.user = user
+        self.password = password
+        self.min_size = min_size
+        self.max_size = max_size
+        self.pool = None
+        self._insert_sql = "INSERT INTO {} ( {} ) VALUES ( {} ) "
+        self._delete_sql = "DELETE FROM {} WHERE {} = $1 "
+        self._touch_sql = "UPDATE {} SET {} = now() WHERE {} = ANY($1::text[]) "
+        self._temp_sql = "CREATE TEMP TABLE {} (LIKE {} INCLUDING DEFAULTS) ON COMMIT DROP "
+        self._geometry_type_sql = "ALTER TABLE {} ALTER COLUMN {} TYPE text "
+        self._upsert_sql = "INSERT INTO {} ( {} ) SELECT {} FROM {} ON CONFLICT ( {} ) {} "
+        self._query_sql = "SELECT {} FROM {} WHERE {} "
+        self._udt_sql = "SELECT column_name, udt_name FROM information_schema.columns WHERE table_name = $1 "
+        self._unique_sql = UNIQUE_INDEX_SQL.format('$1', '$2')
+
+    async def connect(self):
+        if self.pool is None:
+            self.pool = await asyncpg.create_pool(host=self.host, port=5432, user=self.user, password=self.password,
+                                                  database=self.db, min_size=self.min_size, max_size=self.max_size)
+        return self
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    @staticmethod
+    def _placeholders(n):
+        return ','.join('$%d' % (i + 1) for i in range(n))
+
+    async def insert(self, d, tb):
+        sql_ = self._insert_sql.format(tb, ','.join(d.keys()), self._placeholders(len(d)))
+        async with self.pool.acquire() as conn:
+            return await conn.execute(sql_, *d.values())
+
+    async def insert_many(self, rows, tb, columns=None):
+        """
+        同一预编译语句批量执行, 参数在一次往返中流水线发送
+        """
+        if not rows:
+            return 0
+        columns = columns or DBManager._columns(rows)
+        sql_ = self._insert_sql.format(tb, ','.join(columns), self._placeholders(len(columns)))
+        async with self.pool.acquire() as conn:
+            await conn.executemany(sql_, [tuple(row.get(column) for column in columns) for row in rows])
+        return len(rows)
+
+    async def delete(self, key, value, tb):
+        async with self.pool.acquire() as conn:
+            return await conn.execute(self._delete_sql.format(tb, key), value)
+
+    async def delete_and_insert(self, key, d, tb):
+        if key not in d:
+            raise KeyError
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(self._delete_sql.format(tb, key), d[key])
+                await conn.execute(self._insert_sql.format(tb, ','.join(d.keys()), self._placeholders(len(d))),
+                                   *d.values())
+
+    async def touch(self, key, values, tb, column='last_seen'):
+        if not values:
+            return 0
+        async with self.pool.acquire() as conn:
+            return await conn.execute(self._touch_sql.format(tb, column, key), list(values))
+
+    async def upsert_many(self, rows, tb, key='uid', columns=None, geometry=(), touch=None):
+        """
+        批量插入或更新: 二进制COPY到临时表后 INSERT ... ON CONFLICT, 参数含义同 DBManager.upsert_many
+        """
+        rows = list({row[key]: row for row in rows}.values())
+        if not rows:
+            return 0
+        columns = columns or DBManager._columns(rows)
+        tmp = 'tmp_upsert_' + tb.replace('.', '_')
+        select = ','.join("ST_GeomFromText(NULLIF({}, ''), {})".format(column, self.srid) if column in geometry
+                          else column for column in columns)
+        updates = DBManager._updates(columns, key, touch, '{0} = EXCLUDED.{0}')
+        action = 'DO UPDATE SET ' + updates if updates else 'DO NOTHING'
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(self._temp_sql.format(tmp, tb))
+                for column in geometry:
+                    if column in columns:
+                        await conn.execute(self._geometry_type_sql.format(tmp, column))
+                await conn.copy_records_to_table(tmp, records=[tuple(row.get(column) for column in columns)
+                                                               for row in rows], columns=columns)
+                await conn.execute(self._upsert_sql.format(tb, ','.join(columns), select, tmp, key, action))
+        return len(rows)
+
+    async def check_poi_schema(self, tb, key='uid', geometry=(), touch=None):
+        """
+        写入前检查, 同 DBManager.check_poi_schema
+        """
+        async with self.pool.acquire() as conn:
+            udt_names = dict(await conn.fetch(self._udt_sql, tb.split('.')[-1]))
+            unique = bool(udt_names) and await conn.fetchval(self._unique_sql, tb, key) > 0
+        error = DBManager._schema_error(tb, udt_names, unique, key, geometry, touch)
+        if error:
+            raise RuntimeError(error)
+
+    async def query(self, sql, *args):
+        async with self.pool.acquire() as conn:
+            return await conn.fetch(sql, *args)
+
+    async def query_df(self, sql, *args):
+        records = await self.query(sql, *args)
+        return pd.DataFrame([tuple(record) for record in records], columns=list(records[0].keys()) if records else None)
+
+    async def query_bbox(self, tb, min_lon, min_lat, max_lon, max_lat, columns=None):
+        return await self._query_geo(tb, "poi && ST_MakeEnvelope($1, $2, $3, $4, {})".format(self.srid),
+                                     (min_lon, min_lat, max_lon, max_lat), columns)
+
+    async def query_radius(self, tb, lon, lat, radius, columns=None):
+        dlat = radius / 111320.0
+        dlon = radius / (111320.0 * max(math.cos(math.radians(lat)), 0.01))
+        where = "poi && ST_MakeEnvelope($1, $2, $3, $4, {0}) AND " \
+                "ST_DWithin(poi::geography, ST_SetSRID(ST_MakePoint($5, $6), {0})::geography, $7)".format(self.srid)
+        return await self._query_geo(tb, where, (lon - dlon, lat - dlat, lon + dlon, lat + dlat, lon, lat, radius),
+                                     columns)
+
+    async def query_geohash_prefix(self, tb, prefix, columns=None):
+        return await self._query_geo(tb, "geohash LIKE $1", (prefix + '%',), columns)
+
+    async def _query_geo(self, tb, where, params, columns):
+        columns = columns or ['uid', 'name', 'tag', 'geohash', 'province', 'area', 'district',
+                              'ST_AsText(poi) AS poi', 'ST_AsText(aoi) AS aoi']
+        return await self.query_df(self._query_sql.format(','.join(columns), tb, where), *params)
+
+    async def stream(self, tb, columns=None, where=None, params=(), batch_size=10000, fmt='numpy'):
+        """
+        服务端游标流式读取, 参数含义同 DBManager.stream
+        :return: 异步生成器
+        """
+        sql_ = self._query_sql.format(','.join(columns or ['*']), tb, where or 'TRUE')
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                cursor = await conn.cursor(sql_, *params)
+                names = None
+                while True:
+                    rows = await cursor.fetch(batch_size)
+                    if not rows:
+                        break
+                    names = names or list(rows[0].keys())
+                    yield DBManager._to_batch(names, rows, fmt)
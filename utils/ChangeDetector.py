@@ -0,0 +1,91 @@
+import json
+import hashlib
+
+# 比较检索结果指纹, 未变化的uid推送到last seen队列
+# KEYS: 指纹hash, last seen队列
+# ARGV: uid1, 指纹1, uid2, 指纹2 ...
+# 返回: 新增或变化的uid列表
+CHANGED_SCRIPT = """
+local changed, seen = {}, {}
+for i = 1, #ARGV, 2 do
+    if redis.call('HGET', KEYS[1], ARGV[i]) == ARGV[i + 1] then
+        seen[#seen + 1] = ARGV[i]
+    else
+        changed[#changed + 1] = ARGV[i]
+    end
+end
+if #seen > 0 then
+    redis.call('RPUSH', KEYS[2], unpack(seen))
+end
+return changed
+"""
+
+
+class ChangeDetector(object):
+    """
+    刷新模式的变化检测: 按检索结果的 名称、坐标、类型、地址、电话 计算指纹,
+    仅新增或变化的POI需要补充与入库, 未变化的uid批量更新last seen;
+    变化的POI携带指纹推送, 入库提交后才由Persist.py写入指纹, 补充或入库失败的POI下次刷新仍视为变化
+    """
+
+    def __init__(self, r, fingerprint_db, seen_db):
+        """
+        :param fingerprint_db: uid -> 指纹 hash
+        :param seen_db: 未变化uid队列, 由Persist.py批量更新last_seen
+        """
+        self.r = r
+        self.fingerprint_db = fingerprint_db
+        self.seen_db = seen_db
+        self._changed = r.register_script(CHANGED_SCRIPT)
+
+    @staticmethod
+    def fingerprint(content):
+        """
+        :param content: 检索接口返回的单条结果
+        """
+        location = content.get('location') or {}
+        detail_info = content.get('detail_info') or {}
+        values = [content.get('name', ''), location.get('lng', ''), location.get('lat', ''),
+                  detail_info.get('tag', ''), content.get('address', ''), content.get('telephone', '')]
+        return hashlib.md5(json.dumps(values, ensure_ascii=False).encode('utf8')).hexdigest()[:16]
+
+    @staticmethod
+    def _changed_args(fingerprints):
+        args = []
+        for uid, fingerprint in fingerprints.items():
+            args.extend([uid, fingerprint])
+        return args
+
+    def changed(self, fingerprints):
+        """
+        :param fingerprints: {uid: 指纹}
+        :return: 新增或变化的uid列表
+        """
+        if not fingerprints:
+            return []
+        uids = self._changed(keys=[self.fingerprint_db, self.seen_db], args=self._changed_args(fingerprints))
+        return [uid.decode('utf8') for uid in uids]
+
+    def commit(self, fingerprints):
+        """
+        入库提交后写入指纹
+        :param fingerprints: {uid: 指纹}
+        """
+        if fingerprints:
+            self.r.hset(self.fingerprint_db, mapping=fingerprints)
+
+
+class AsyncChangeDetector(ChangeDetector):
+    """
+    ChangeDetector的asyncio版本, 需传入redis.asyncio连接
+    """
+
+    async def changed(self, fingerprints):
+        if not fingerprints:
+            return []
+        uids = await self._changed(keys=[self.fingerprint_db, self.seen_db], args=self._changed_args(fingerprints))
+        return [uid.decode('utf8') for uid in uids]
+
+    async def commit(self, fingerprints):
+        if fingerprints:
+            await self.r.hset(self.fingerprint_db, mapping=fingerprints)
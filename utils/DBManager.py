@@ -1,11 +1,56 @@
+import io
+import csv
+import math
+import uuid
+import numpy as np
 from DBUtils.PooledDB import PooledDB
 import pymysql
+import pymysql.cursors
 from psycopg2 import pool
 import pandas as pd
 from sqlalchemy.engine import create_engine
 
+# POI表结构(PostgreSQL + PostGIS), poi/aoi 为WGS84几何列, 标签拆分到 {tb}_tag 表由触发器维护
+POI_TABLE_SQL = [
+    "CREATE EXTENSION IF NOT EXISTS postgis",
+    "CREATE TABLE IF NOT EXISTS {tb} ( uid text PRIMARY KEY, poi geometry(Point, {srid}), name text, geohash text, "
+    "province text, area text, district text, tag text, telephone text, aoi geometry(Geometry, {srid}), "
+    "attribute text, last_seen timestamptz DEFAULT now() )",
+    "ALTER TABLE {tb} ADD COLUMN IF NOT EXISTS last_seen timestamptz DEFAULT now()",
+]
+
+POI_INDEX_SQL = [
+    "CREATE UNIQUE INDEX IF NOT EXISTS {tb}_uid_key ON {tb} ( uid )",
+    "CREATE INDEX IF NOT EXISTS {tb}_poi_gist ON {tb} USING GIST ( poi )",
+    "CREATE INDEX IF NOT EXISTS {tb}_aoi_gist ON {tb} USING GIST ( aoi )",
+    # 前缀查询 geohash LIKE 'wx4g%' 走索引
+    "CREATE INDEX IF NOT EXISTS {tb}_geohash_prefix ON {tb} ( geohash text_pattern_ops )",
+    "CREATE TABLE IF NOT EXISTS {tb}_tag ( uid text PRIMARY KEY REFERENCES {tb} ( uid ) ON DELETE CASCADE, "
+    "category text, subcategory text )",
+    "CREATE INDEX IF NOT EXISTS {tb}_tag_category ON {tb}_tag ( category, subcategory )",
+    "CREATE INDEX IF NOT EXISTS {tb}_tag_subcategory ON {tb}_tag ( subcategory )",
+    "CREATE OR REPLACE FUNCTION {tb}_tag_sync() RETURNS trigger AS $$ BEGIN "
+    "INSERT INTO {tb}_tag ( uid, category, subcategory ) "
+    "VALUES ( NEW.uid, split_part(NEW.tag, ';', 1), NULLIF(split_part(NEW.tag, ';', 2), '') ) "
+    "ON CONFLICT ( uid ) DO UPDATE SET category = EXCLUDED.category, subcategory = EXCLUDED.subcategory; "
+    "RETURN NEW; END $$ LANGUAGE plpgsql",
+    "DROP TRIGGER IF EXISTS {tb}_tag_sync ON {tb}",
+    "CREATE TRIGGER {tb}_tag_sync AFTER INSERT OR UPDATE OF tag ON {tb} FOR EACH ROW EXECUTE PROCEDURE {tb}_tag_sync()",
+    "INSERT INTO {tb}_tag ( uid, category, subcategory ) "
+    "SELECT uid, split_part(tag, ';', 1), NULLIF(split_part(tag, ';', 2), '') FROM {tb} ON CONFLICT DO NOTHING",
+]
+
+
+# key 列上的单列唯一索引(含主键), upsert 的 ON CONFLICT 依赖它
+UNIQUE_INDEX_SQL = "SELECT count(*) FROM pg_index i " \
+                   "JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0] " \
+                   "WHERE i.indrelid = {}::regclass AND i.indisunique AND i.indnatts = 1 AND a.attname = {} "
+
 
 class DBManager(object):
+    # 几何列坐标系 WGS84
+    srid = 4326
+
     def __init__(self, host, db=None, user=None, password=None, dbtype=None):
         if dbtype == 'mysql':
             driver_str = "mysql+pymysql"
@@ -40,6 +85,19 @@ class DBManager(object):
         self.engine = create_engine("%s://%s%s:%d/%s" % (driver_str, app_str, host, port, db))
         self._insert_sql = "INSERT INTO {} ( {} ) VALUES ( {} ) "
         self._delete_sql = "DELETE FROM {} WHERE {} = '{}' "
+        self._touch_sql = "UPDATE {} SET {} = now() WHERE {} IN %s "
+        self._temp_sql = "CREATE TEMP TABLE {} (LIKE {} INCLUDING DEFAULTS) ON COMMIT DROP "
+        self._copy_sql = "COPY {} ( {} ) FROM STDIN WITH (FORMAT csv, NULL '\\N') "
+        self._pg_upsert_sql = "INSERT INTO {} ( {} ) SELECT {} FROM {} ON CONFLICT ( {} ) {} "
+        self._geometry_type_sql = "ALTER TABLE {} ALTER COLUMN {} TYPE text "
+        self._column_type_sql = "SELECT data_type FROM information_schema.columns " \
+                                "WHERE table_name = %s AND column_name = %s "
+        self._to_geometry_sql = "ALTER TABLE {0} ALTER COLUMN {1} TYPE geometry({2}, {3}) " \
+                                "USING ST_GeomFromText(NULLIF({1}, ''), {3}) "
+        self._udt_sql = "SELECT column_name, udt_name FROM information_schema.columns WHERE table_name = %s "
+        self._unique_sql = UNIQUE_INDEX_SQL.format('%s', '%s')
+        self._query_sql = "SELECT {} FROM {} WHERE {} "
+        self._mysql_upsert_sql = "INSERT INTO {} ( {} ) VALUES ( {} ) ON DUPLICATE KEY UPDATE {} "
         self._dbtype = dbtype
 
     def __del__(self):
@@ -82,12 +140,271 @@ class DBManager(object):
         self._close_connect(conn, cursor)
         return ret
 
+    def touch(self, key, values, tb, column='last_seen'):
+        """
+        将 key 在 values 中的行的时间列批量更新为当前时间
+        """
+        if not values:
+            return 0
+        sql_ = self._touch_sql.format(tb, column, key)
+        conn, cursor = self._get_connect()
+        try:
+            ret = cursor.execute(sql_, (tuple(values),))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self._close_connect(conn, cursor)
+        return ret
+
+    @staticmethod
+    def _columns(rows):
+        columns = []
+        for row in rows:
+            for column in row:
+                if column not in columns:
+                    columns.append(column)
+        return columns
+
+    @staticmethod
+    def _updates(columns, key, touch, fmt):
+        updates = [fmt.format(column) for column in columns if column != key]
+        if touch:
+            updates.append('{} = now()'.format(touch))
+        return ','.join(updates)
+
+    def _pg_upsert(self, cursor, columns, values, tb, key, geometry, touch=None):
+        # COPY 到事务级临时表, 几何列在临时表中为WKT文本, 合并到目标表时转换
+        tmp = 'tmp_upsert_' + tb.replace('.', '_')
+        buf = io.StringIO()
+        # None 写为 \N 作为NULL标记, 与空字符串区分
+        csv.writer(buf).writerows([['\\N' if value is None else value for value in row] for row in values])
+        buf.seek(0)
+        cursor.execute(self._temp_sql.format(tmp, tb))
+        for column in geometry:
+            if column in columns:
+                cursor.execute(self._geometry_type_sql.format(tmp, column))
+        cursor.copy_expert(self._copy_sql.format(tmp, ','.join(columns)), buf)
+        select = ','.join("ST_GeomFromText(NULLIF({}, ''), {})".format(column, self.srid) if column in geometry
+                          else column for column in columns)
+        updates = self._updates(columns, key, touch, '{0} = EXCLUDED.{0}')
+        action = 'DO UPDATE SET ' + updates if updates else 'DO NOTHING'
+        cursor.execute(self._pg_upsert_sql.format(tb, ','.join(columns), select, tmp, key, action))
+
+    def _mysql_upsert(self, cursor, columns, values, tb, key, geometry, touch=None):
+        updates = self._updates(columns, key, touch, '{0} = VALUES({0})')
+        updates = updates or '{0} = {0}'.format(key)
+        # 纯占位符才能被pymysql合并为多行INSERT, MySQL不做几何列转换, WKT按原列类型写入
+        placeholders = ','.join(['%s'] * len(columns))
+        sql_ = self._mysql_upsert_sql.format(tb, ','.join(columns), placeholders, updates)
+        cursor.executemany(sql_, values)
+
+    def upsert_many(self, rows, tb, key='uid', columns=None, geometry=(), touch=None):
+        """
+        批量插入或更新, 一个事务提交, 同一批内 key 重复时保留最后一条
+        PostgreSQL: COPY 到临时表后 INSERT ... ON CONFLICT, 要求 key 上有唯一索引
+        MySQL: INSERT ... ON DUPLICATE KEY UPDATE 批量执行
+        :param rows: dict列表, 缺失的列写入NULL
+        :param columns: 写入的列, 默认为各行字段的并集; 指定后不在其中的字段被忽略
+        :param geometry: 值为WKT的几何列, 经 ST_GeomFromText 写入(仅PostgreSQL, MySQL忽略)
+        :param touch: 时间列, 已存在的行更新时置为当前时间(新插入的行取列默认值)
+        :return: 写入行数
+        """
+        rows = list({row[key]: row for row in rows}.values())
+        if not rows:
+            return 0
+        columns = columns or self._columns(rows)
+        values = [tuple(row.get(column) for column in columns) for row in rows]
+        conn, cursor = self._get_connect()
+        try:
+            if self._dbtype == 'postgresql':
+                self._pg_upsert(cursor, columns, values, tb, key, geometry, touch)
+            else:
+                self._mysql_upsert(cursor, columns, values, tb, key, geometry, touch)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self._close_connect(conn, cursor)
+        return len(rows)
+
     def delete_and_insert(self, key, d, tb):
         if key not in d:
             raise KeyError
         self.delete(key, d.get(key), tb)
         self.insert(d, tb)
 
+    def create_poi_schema(self, tb):
+        """
+        创建或迁移POI表(仅PostgreSQL): 文本WKT列转为几何列, 建立GiST索引、geohash前缀索引与标签表
+        """
+        if self._dbtype != 'postgresql':
+            raise TypeError
+        conn, cursor = self._get_connect()
+        try:
+            for sql_ in POI_TABLE_SQL:
+                cursor.execute(sql_.format(tb=tb, srid=self.srid))
+            # 旧表的 poi/aoi 为WKT文本, 建索引前先迁移
+            for column, geometry_type in (('poi', 'Point'), ('aoi', 'Geometry')):
+                cursor.execute(self._column_type_sql, (tb.split('.')[-1], column))
+                data_type = cursor.fetchone()
+                if data_type and data_type[0] in ('text', 'character varying'):
+                    cursor.execute(self._to_geometry_sql.format(tb, column, geometry_type, self.srid))
+            for sql_ in POI_INDEX_SQL:
+                cursor.execute(sql_.format(tb=tb, srid=self.srid))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self._close_connect(conn, cursor)
+
+    @staticmethod
+    def _schema_error(tb, udt_names, unique, key, geometry, touch=None):
+        """
+        :param udt_names: {列名: 类型名}, 表不存在时为空
+        :param unique: key 列是否有唯一索引
+        :param touch: upsert 时刷新的时间列
+        :return: 表结构不满足写入要求时的说明, 满足时返回None
+        """
+        if not udt_names:
+            problems = ['表不存在']
+        else:
+            problems = ['%s 列不是geometry类型' % column for column in geometry
+                        if column and udt_names.get(column) != 'geometry']
+            if not unique:
+                problems.append('%s 列缺少唯一索引' % key)
+            if touch and touch not in udt_names:
+                problems.append('缺少 %s 列' % touch)
+        if problems:
+            return "表 %s 结构不满足写入要求(%s), 请先执行 python Persist.py schema" % (tb, ', '.join(problems))
+
+    def check_poi_schema(self, tb, key='uid', geometry=(), touch=None):
+        """
+        写入前检查(仅PostgreSQL): 几何列为geometry类型, key 上有唯一索引, 时间列存在, 否则 upsert_many 会写入错误类型或每批失败
+        :raise RuntimeError: 表结构不满足要求
+        """
+        if self._dbtype != 'postgresql':
+            return
+        conn, cursor = self._get_connect()
+        try:
+            cursor.execute(self._udt_sql, (tb.split('.')[-1],))
+            udt_names = dict(cursor.fetchall())
+            unique = False
+            if udt_names:
+                cursor.execute(self._unique_sql, (tb, key))
+                unique = cursor.fetchone()[0] > 0
+            conn.rollback()
+        finally:
+            self._close_connect(conn, cursor)
+        error = self._schema_error(tb, udt_names, unique, key, geometry, touch)
+        if error:
+            raise RuntimeError(error)
+
+    def _query_geo(self, tb, where, params, columns):
+        # 几何列以WKT返回
+        columns = columns or ['uid', 'name', 'tag', 'geohash', 'province', 'area', 'district',
+                              'ST_AsText(poi) AS poi', 'ST_AsText(aoi) AS aoi']
+        return pd.read_sql(self._query_sql.format(','.join(columns), tb, where), self.engine, params=params)
+
+    def query_bbox(self, tb, min_lon, min_lat, max_lon, max_lat, columns=None):
+        """
+        查询矩形范围内的POI, 走 poi 的GiST索引
+        """
+        return self._query_geo(tb, "poi && ST_MakeEnvelope(%s, %s, %s, %s, {})".format(self.srid),
+                               (min_lon, min_lat, max_lon, max_lat), columns)
+
+    def query_radius(self, tb, lon, lat, radius, columns=None):
+        """
+        查询距 (lon, lat) radius 米内的POI, 先按外接矩形走索引再按球面距离过滤
+        """
+        dlat = radius / 111320.0
+        dlon = radius / (111320.0 * max(math.cos(math.radians(lat)), 0.01))
+        where = "poi && ST_MakeEnvelope(%s, %s, %s, %s, {0}) AND " \
+                "ST_DWithin(poi::geography, ST_SetSRID(ST_MakePoint(%s, %s), {0})::geography, %s)".format(self.srid)
+        return self._query_geo(tb, where, (lon - dlon, lat - dlat, lon + dlon, lat + dlat, lon, lat, radius), columns)
+
+    def query_geohash_prefix(self, tb, prefix, columns=None):
+        """
+        查询geohash以prefix开头的POI, 走 text_pattern_ops 索引
+        """
+        return self._query_geo(tb, "geohash LIKE %s", (prefix + '%',), columns)
+
+    def geohash_density(self, tb, prefixes, length, keywords=None):
+        """
+        按geohash前缀统计POI数量(PostgreSQL), 走 text_pattern_ops 索引
+        :param prefixes: 统计范围的geohash前缀列表
+        :param length: 统计粒度的geohash长度
+        :param keywords: 大类或小类名称列表, 按 {tb}_tag 过滤, 为空时统计全部类型
+        :return: {长度为length的前缀: 数量}
+        """
+        if not prefixes:
+            return {}
+        where = '( ' + ' OR '.join(['geohash LIKE %s'] * len(prefixes)) + ' )'
+        params = [length] + [prefix + '%' for prefix in prefixes]
+        if keywords:
+            where += ' AND uid IN ( SELECT uid FROM {}_tag WHERE category = ANY(%s) OR subcategory = ANY(%s) )'.format(tb)
+            params += [list(keywords), list(keywords)]
+        conn, cursor = self._get_connect()
+        try:
+            cursor.execute(self._query_sql.format('left(geohash, %s), count(*)', tb, where) + 'GROUP BY 1', params)
+            return dict(cursor.fetchall())
+        finally:
+            conn.rollback()
+            self._close_connect(conn, cursor)
+
+    @staticmethod
+    def _to_array(values):
+        array = np.asarray(values)
+        # 字符串列使用object数组, 避免按最长字符串定长分配
+        return array.astype(object) if array.dtype.kind == 'U' else array
+
+    @staticmethod
+    def _to_batch(names, rows, fmt):
+        columns = list(zip(*rows))
+        if fmt == 'arrow':
+            import pyarrow as pa
+            return pa.RecordBatch.from_arrays([pa.array(column) for column in columns], names=names)
+        return {name: DBManager._to_array(column) for name, column in zip(names, columns)}
+
+    def stream(self, tb, columns=None, where=None, params=None, batch_size=10000, fmt='numpy'):
+        """
+        服务端游标流式读取, 内存占用与表大小无关
+        PostgreSQL 使用命名游标, MySQL 使用 SSCursor
+        :param tb: 表名
+        :param columns: 投影列, 可为SQL表达式如 'ST_AsText(aoi) AS aoi', 默认全部列
+        :param where: 过滤条件, 值以 %s 占位
+        :param params: where 中占位符对应的值
+        :param fmt: numpy 返回 {列名: ndarray}, arrow 返回 pyarrow.RecordBatch
+        :return: 按 batch_size 分批的生成器
+        """
+        sql_ = self._query_sql.format(','.join(columns or ['*']), tb, where or 'TRUE')
+        conn = self.pool.getconn() if self._dbtype == 'postgresql' else self.pool.connection()
+        if self._dbtype == 'postgresql':
+            cursor = conn.cursor(name='stream_' + uuid.uuid4().hex)
+            cursor.itersize = batch_size
+        else:
+            cursor = conn.cursor(pymysql.cursors.SSCursor)
+        try:
+            cursor.execute(sql_, params)
+            names = None
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                # 命名游标在取到第一批后才有列描述
+                names = names or [desc[0] for desc in cursor.description]
+                yield self._to_batch(names, rows, fmt)
+        finally:
+            cursor.close()
+            if self._dbtype == 'postgresql':
+                conn.rollback()
+                self.pool.putconn(conn)
+            else:
+                conn.close()
+
     def query_df(self, sql):
         return pd.read_sql(sql, self.engine)
 
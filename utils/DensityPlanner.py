@@ -0,0 +1,91 @@
+import geohash
+from shapely.geometry import box
+from shapely.prepared import prep
+
+BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+
+class DensityPlanner(object):
+    """
+    按历史POI密度生成变尺寸切片: 预计结果数低于上限的geohash块整体检索, 超过的逐级细分,
+    同一行相邻的稀疏块合并为一个矩形, 空旷区域只需少量请求
+    """
+
+    def __init__(self, db, tb, min_length=4, max_length=7, limit=400, margin=1.5):
+        """
+        :param db: DBManager, 读取 tb 的历史POI
+        :param min_length: 初始切片的geohash长度
+        :param max_length: 细分的最大geohash长度, 超过上限的由爬虫按结果总数继续拆分
+        :param limit: 单次检索结果上限
+        :param margin: 历史数量的放大系数, 预留新增POI的余量
+        """
+        self.db = db
+        self.tb = tb
+        self.min_length = min_length
+        self.max_length = max_length
+        self.threshold = limit / margin
+
+    @staticmethod
+    def _bounds(cell):
+        bbox = geohash.bbox(cell)
+        return bbox['s'], bbox['w'], bbox['n'], bbox['e']
+
+    def _intersects(self, prepared, cell):
+        s, w, n, e = self._bounds(cell)
+        return prepared.intersects(box(w, s, e, n))
+
+    def _cells(self, polygon):
+        from utils.geohash import GeohashOperator
+        geo = GeohashOperator()
+        cells = set()
+        for poly in getattr(polygon, 'geoms', [polygon]):
+            cells.update(geo.polygon_geohasher(poly, self.min_length, self.min_length, True))
+        return sorted(cells)
+
+    def _counts(self, cells, keywords):
+        # 最细粒度统计后向上汇总到各级前缀
+        counts = {}
+        for prefix, n in self.db.geohash_density(self.tb, cells, self.max_length, keywords).items():
+            for length in range(self.min_length, len(prefix) + 1):
+                counts[prefix[:length]] = counts.get(prefix[:length], 0) + n
+        return counts
+
+    def _merge(self, cells, counts):
+        """
+        同一行的相邻块在合计数量不超过阈值时合并
+        :return: [(最小纬度, 最小经度, 最大纬度, 最大经度), ...]
+        """
+        rows = {}
+        for cell in cells:
+            s, w, n, e = self._bounds(cell)
+            rows.setdefault((s, n), []).append((w, e, counts.get(cell, 0)))
+        boxes = []
+        for (s, n), row in sorted(rows.items()):
+            row.sort()
+            start, end, total = row[0]
+            for w, e, count in row[1:]:
+                if abs(w - end) < 1e-9 and total + count < self.threshold:
+                    end, total = e, total + count
+                else:
+                    boxes.append((s, start, n, end))
+                    start, end, total = w, e, count
+            boxes.append((s, start, n, end))
+        return boxes
+
+    def plan(self, polygon, keywords=None):
+        """
+        :param polygon: 城市边界
+        :param keywords: 检索词对应的大类或小类名称, 为空时按全部类型估计
+        :return: [(最小纬度, 最小经度, 最大纬度, 最大经度), ...]
+        """
+        prepared = prep(polygon)
+        cells = self._cells(polygon)
+        counts = self._counts(cells, keywords)
+        boxes, groups = [], [cells]
+        while groups:
+            group = groups.pop()
+            dense = [cell for cell in group if counts.get(cell, 0) >= self.threshold and len(cell) < self.max_length]
+            boxes.extend(self._merge([cell for cell in group if cell not in dense], counts))
+            for cell in dense:
+                groups.append([cell + char for char in BASE32 if self._intersects(prepared, cell + char)])
+        return boxes
@@ -1,7 +1,15 @@
-import math
+import numpy as np
+
+
+class GISError(Exception):
+    pass
+
 
 class GisTransformer(object):
-    """gis坐标转换类"""
+    """gis坐标转换类
+
+    *_array 方法接受 (N, 2) 的 [lng, lat] 数组并返回同形状数组, 同名标量方法为其包装
+    """
     MCBAND = (12890594.86, 8362377.87, 5591021, 3481989.83, 1678043.12, 0)
     MC2LL = ([1.410526172116255e-8, 0.00000898305509648872, -1.9939833816331,
           200.9824383106796, -187.2403703815547, 91.6087516669843, - 23.38765649603339,
@@ -21,6 +29,8 @@ class GisTransformer(object):
          [2.890871144776878e-9, 0.000008983055095805407, -3.068298e-8, 7.47137025468032,
           -0.00000353937994, -0.02145144861037, -0.00001234426596, 0.00010322952773,
           -0.00000323890364, 826088.5])
+    _MCBAND = np.array(MCBAND)
+    _MC2LL = np.array(MC2LL)
 
     def __init__(self, old_gis_name, new_gis_name):
         """
@@ -36,6 +46,16 @@ class GisTransformer(object):
         func_name = old_gis_name + '_to_' + new_gis_name
         if hasattr(self, func_name):
             self.transform_func = getattr(self, func_name)
+            self.transform_array = getattr(self, func_name + '_array')
+
+    @staticmethod
+    def _scalar(func, x, y):
+        lng, lat = func(np.array([[x, y]], dtype=np.float64))[0]
+        return float(lng), float(lat)
+
+    @staticmethod
+    def _stack(lng, lat):
+        return np.stack([lng, lat], axis=-1)
 
     def _out_of_china(self, lng, lat):
         """
@@ -44,52 +64,131 @@ class GisTransformer(object):
         :param lat:
         :return:
         """
-        return not (lng > 73.66 and lng < 135.05 and lat > 3.86 and lat < 53.55)
+        return np.logical_not((lng > 73.66) & (lng < 135.05) & (lat > 3.86) & (lat < 53.55))
 
     def _transformlat(self, lng, lat):
         ret = -100.0 + 2.0 * lng + 3.0 * lat + 0.2 * lat * lat + \
-              0.1 * lng * lat + 0.2 * math.sqrt(math.fabs(lng))
-        ret += (20.0 * math.sin(6.0 * lng * self.pi) + 20.0 *
-                math.sin(2.0 * lng * self.pi)) * 2.0 / 3.0
-        ret += (20.0 * math.sin(lat * self.pi) + 40.0 *
-                math.sin(lat / 3.0 * self.pi)) * 2.0 / 3.0
-        ret += (160.0 * math.sin(lat / 12.0 * self.pi) + 320 *
-                math.sin(lat * self.pi / 30.0)) * 2.0 / 3.0
+              0.1 * lng * lat + 0.2 * np.sqrt(np.fabs(lng))
+        ret += (20.0 * np.sin(6.0 * lng * self.pi) + 20.0 *
+                np.sin(2.0 * lng * self.pi)) * 2.0 / 3.0
+        ret += (20.0 * np.sin(lat * self.pi) + 40.0 *
+                np.sin(lat / 3.0 * self.pi)) * 2.0 / 3.0
+        ret += (160.0 * np.sin(lat / 12.0 * self.pi) + 320 *
+                np.sin(lat * self.pi / 30.0)) * 2.0 / 3.0
         return ret
 
     def _transformlng(self, lng, lat):
         ret = 300.0 + lng + 2.0 * lat + 0.1 * lng * lng + \
-              0.1 * lng * lat + 0.1 * math.sqrt(math.fabs(lng))
-        ret += (20.0 * math.sin(6.0 * lng * self.pi) + 20.0 *
-                math.sin(2.0 * lng * self.pi)) * 2.0 / 3.0
-        ret += (20.0 * math.sin(lng * self.pi) + 40.0 *
-                math.sin(lng / 3.0 * self.pi)) * 2.0 / 3.0
-        ret += (150.0 * math.sin(lng / 12.0 * self.pi) + 300.0 *
-                math.sin(lng / 30.0 * self.pi)) * 2.0 / 3.0
+              0.1 * lng * lat + 0.1 * np.sqrt(np.fabs(lng))
+        ret += (20.0 * np.sin(6.0 * lng * self.pi) + 20.0 *
+                np.sin(2.0 * lng * self.pi)) * 2.0 / 3.0
+        ret += (20.0 * np.sin(lng * self.pi) + 40.0 *
+                np.sin(lng / 3.0 * self.pi)) * 2.0 / 3.0
+        ret += (150.0 * np.sin(lng / 12.0 * self.pi) + 300.0 *
+                np.sin(lng / 30.0 * self.pi)) * 2.0 / 3.0
         return ret
 
-    def wgs84_to_webMercator(self, lon, lat):
+    def _gcj02_offset(self, lng, lat):
+        # 国测局偏移量, wgs84与gcj02互转共用
+        dlat = self._transformlat(lng - 105.0, lat - 35.0)
+        dlng = self._transformlng(lng - 105.0, lat - 35.0)
+        radlat = lat / 180.0 * self.pi
+        magic = np.sin(radlat)
+        magic = 1 - self.ee * magic * magic
+        sqrtmagic = np.sqrt(magic)
+        dlat = (dlat * 180.0) / ((self.a * (1 - self.ee)) / (magic * sqrtmagic) * self.pi)
+        dlng = (dlng * 180.0) / (self.a / sqrtmagic * np.cos(radlat) * self.pi)
+        return dlng, dlat
+
+    def wgs84_to_webMercator_array(self, coords):
         """wgs84坐标 转 墨卡托坐标"""
+        lon, lat = coords[:, 0], coords[:, 1]
         x = lon * 20037508.342789 / 180
-        y = math.log(math.tan((90 + lat) * self.pi / 360)) / (self.pi / 180)
+        y = np.log(np.tan((90 + lat) * self.pi / 360)) / (self.pi / 180)
         y = y * 20037508.34789 / 180
-        return x, y
+        return self._stack(x, y)
+
+    def gcj02_to_webMercator_array(self, coords):
+        """火星转墨卡托"""
+        return self.wgs84_to_webMercator_array(self.gcj02_to_wgs84_array(coords))
+
+    def webMercator_to_webMercator_array(self, coords):
+        return np.array(coords, dtype=np.float64)
+
+    def webMercator_to_wgs84_array(self, coords):
+        """墨卡托坐标 转 wgs84坐标"""
+        lon = coords[:, 0] / 20037508.34 * 180
+        lat = coords[:, 1] / 20037508.34 * 180
+        lat = 180 / self.pi * (2 * np.arctan(np.exp(lat * self.pi / 180)) - self.pi / 2)
+        return self._stack(lon, lat)
+
+    def gcj02_to_wgs84_array(self, coords):
+        """
+        GCJ02(火星坐标系)转GPS84
+        :param coords: 火星坐标系的 [经度, 纬度] 数组
+        :return:
+        """
+        lng, lat = coords[:, 0], coords[:, 1]
+        dlng, dlat = self._gcj02_offset(lng, lat)
+        new_x = lng * 2 - (lng + dlng)
+        new_y = lat * 2 - (lat + dlat)
+        out = self._out_of_china(lng, lat)
+        return self._stack(np.where(out, lng, new_x), np.where(out, lat, new_y))
+
+    def wgs84_to_gcj02_array(self, coords):
+        """
+        WGS84转GCJ02(火星坐标系)
+        :param coords: WGS84坐标系的 [经度, 纬度] 数组
+        :return:
+        """
+        lng, lat = coords[:, 0], coords[:, 1]
+        dlng, dlat = self._gcj02_offset(lng, lat)
+        out = self._out_of_china(lng, lat)  # 判断是否在国内
+        return self._stack(np.where(out, lng, lng + dlng), np.where(out, lat, lat + dlat))
+
+    def webMercator_to_gcj02_array(self, coords):
+        """墨卡托转火星"""
+        return self.wgs84_to_gcj02_array(self.webMercator_to_wgs84_array(coords))
+
+    def gcj02_to_bd09_array(self, coords):
+        lng, lat = coords[:, 0], coords[:, 1]
+        z = np.sqrt(lng * lng + lat * lat) + 0.00002 * np.sin(lat * self.x_pi)
+        theta = np.arctan2(lat, lng) + 0.000003 * np.cos(lng * self.x_pi)
+        return self._stack(z * np.cos(theta) + 0.0065, z * np.sin(theta) + 0.006)
+
+    def bd09_to_gcj02_array(self, coords):
+        x = coords[:, 0] - 0.0065
+        y = coords[:, 1] - 0.006
+        z = np.sqrt(x * x + y * y) - 0.00002 * np.sin(y * self.x_pi)
+        theta = np.arctan2(y, x) - 0.000003 * np.cos(x * self.x_pi)
+        return self._stack(z * np.cos(theta), z * np.sin(theta))
+
+    def wgs84_to_bd09_array(self, coords):
+        return self.gcj02_to_bd09_array(self.wgs84_to_gcj02_array(coords))
+
+    def bd09_to_wgs84_array(self, coords):
+        return self.gcj02_to_wgs84_array(self.bd09_to_gcj02_array(coords))
+
+    def webMercator_to_bd09_array(self, coords):
+        return self.gcj02_to_bd09_array(self.webMercator_to_gcj02_array(coords))
+
+    def bd09_to_webMercator_array(self, coords):
+        return self.gcj02_to_bd09_array(self.bd09_to_gcj02_array(coords))
+
+    def wgs84_to_webMercator(self, lon, lat):
+        """wgs84坐标 转 墨卡托坐标"""
+        return self._scalar(self.wgs84_to_webMercator_array, lon, lat)
 
     def gcj02_to_webMercator(self, x, y):
         """火星转墨卡托"""
-        wgs84_x, wgs84_y = self.gcj02_to_wgs84(x, y)
-        webMercator_x, webMercator_y = self.wgs84_to_webMercator(wgs84_x, wgs84_y)
-        return webMercator_x, webMercator_y
+        return self._scalar(self.gcj02_to_webMercator_array, x, y)
 
     def webMercator_to_webMercator(self, x, y):
         return x, y
 
     def webMercator_to_wgs84(self, x, y):
         """墨卡托坐标 转 wgs84坐标"""
-        lon = x / 20037508.34 * 180
-        lat = y / 20037508.34 * 180
-        lat = 180 / self.pi * (2 * math.atan(math.exp(lat * self.pi / 180)) - self.pi / 2)
-        return lon, lat
+        return self._scalar(self.webMercator_to_wgs84_array, x, y)
 
     def gcj02_to_wgs84(self, lng, lat):
         """
@@ -98,21 +197,7 @@ class GisTransformer(object):
         :param lat:火星坐标系纬度
         :return:
         """
-        if self._out_of_china(lng, lat):
-            return lng, lat
-        dlat = self._transformlat(lng - 105.0, lat - 35.0)
-        dlng = self._transformlng(lng - 105.0, lat - 35.0)
-        radlat = lat / 180.0 * self.pi
-        magic = math.sin(radlat)
-        magic = 1 - self.ee * magic * magic
-        sqrtmagic = math.sqrt(magic)
-        dlat = (dlat * 180.0) / ((self.a * (1 - self.ee)) / (magic * sqrtmagic) * self.pi)
-        dlng = (dlng * 180.0) / (self.a / sqrtmagic * math.cos(radlat) * self.pi)
-        mglat = lat + dlat
-        mglng = lng + dlng
-        new_x = lng * 2 - mglng
-        new_y = lat * 2 - mglat
-        return new_x, new_y
+        return self._scalar(self.gcj02_to_wgs84_array, lng, lat)
 
     def wgs84_to_gcj02(self, lng, lat):
         """
@@ -121,62 +206,58 @@ class GisTransformer(object):
         :param lat:WGS84坐标系的纬度
         :return:
         """
-        if self._out_of_china(lng, lat):  # 判断是否在国内
-            return lng, lat
-        dlat = self._transformlat(lng - 105.0, lat - 35.0)
-        dlng = self._transformlng(lng - 105.0, lat - 35.0)
-        radlat = lat / 180.0 * self.pi
-        magic = math.sin(radlat)
-        magic = 1 - self.ee * magic * magic
-        sqrtmagic = math.sqrt(magic)
-        dlat = (dlat * 180.0) / ((self.a * (1 - self.ee)) / (magic * sqrtmagic) * self.pi)
-        dlng = (dlng * 180.0) / (self.a / sqrtmagic * math.cos(radlat) * self.pi)
-        mglat = lat + dlat
-        mglng = lng + dlng
-        return mglng, mglat
+        return self._scalar(self.wgs84_to_gcj02_array, lng, lat)
 
     def webMercator_to_gcj02(self, x, y):
         """墨卡托转火星"""
-        wgs84_x, wgs84_y = self.webMercator_to_wgs84(x, y)
-        gcj02_x, gcj02_y = self.wgs84_to_gcj02(wgs84_x, wgs84_y)
-        return gcj02_x, gcj02_y
-
-    def gcj02_to_bd09(self , lng , lat ):
-        z = math.sqrt(lng * lng + lat * lat) + 0.00002 * math.sin(lat * self.x_pi)
-        theta = math.atan2(lat, lng) + 0.000003 * math.cos(lng * self.x_pi)
-        bd_lng = z * math.cos(theta) + 0.0065
-        bd_lat = z * math.sin(theta) + 0.006
-        return bd_lng , bd_lat
-
-    def bd09_to_gcj02(self , lng , lat):
-        x = lng - 0.0065
-        y = lat - 0.006
-        z = math.sqrt(x * x + y * y) - 0.00002 * math.sin(y * self.x_pi)
-        theta = math.atan2(y, x) - 0.000003 * math.cos(x * self.x_pi)
-        gg_lng = z * math.cos(theta)
-        gg_lat = z * math.sin(theta)
-        return gg_lng , gg_lat
-
-    def wgs84_to_bd09(self , lng , lat ):
-        gcj02_lng , gcj02_lat = self.wgs84_to_gcj02(lng , lat)
-        bd09_lng , bd09_lat = self.gcj02_to_bd09(gcj02_lng , gcj02_lat)
-        return bd09_lng , bd09_lat
-
-    def bd09_to_wgs84(self , lng , lat ):
-        gcj02_lng, gcj02_lat = self.bd09_to_gcj02(lng, lat)
-        wgs84_lng, wgs84_lat = self.gcj02_to_wgs84(gcj02_lng, gcj02_lat)
-        return wgs84_lng, wgs84_lat
-
-    def webMercator_to_bd09(self , lng , lat ):
-        gcj02_lng, gcj02_lat = self.webMercator_to_gcj02(lng , lat )
-        return self.gcj02_to_bd09(gcj02_lng, gcj02_lat)
-
-    def bd09_to_webMercator(self , lng , lat):
-        gcj02_lng, gcj02_lat = self.bd09_to_gcj02(lng , lat)
-        return self.gcj02_to_bd09(gcj02_lng, gcj02_lat)
-
-
-    def convert_MCT_2_BD09(self , lon, lat):
+        return self._scalar(self.webMercator_to_gcj02_array, x, y)
+
+    def gcj02_to_bd09(self, lng, lat):
+        return self._scalar(self.gcj02_to_bd09_array, lng, lat)
+
+    def bd09_to_gcj02(self, lng, lat):
+        return self._scalar(self.bd09_to_gcj02_array, lng, lat)
+
+    def wgs84_to_bd09(self, lng, lat):
+        return self._scalar(self.wgs84_to_bd09_array, lng, lat)
+
+    def bd09_to_wgs84(self, lng, lat):
+        return self._scalar(self.bd09_to_wgs84_array, lng, lat)
+
+    def webMercator_to_bd09(self, lng, lat):
+        return self._scalar(self.webMercator_to_bd09_array, lng, lat)
+
+    def bd09_to_webMercator(self, lng, lat):
+        return self._scalar(self.bd09_to_webMercator_array, lng, lat)
+
+    def convert_MCT_2_BD09_array(self, coords):
+        """将墨卡托坐标数组转换成BD09
+            Args:
+                coords: (N, 2) 数组, [经度, 纬度]
+            Returns:
+                (N, 2) 数组, 经过转换的 [x, y]
+        """
+        lon, lat = coords[:, 0], coords[:, 1]
+
+        # 每个点取第一个满足 lat >= MCBAND 的分段系数
+        band = lat[:, None] >= self._MCBAND[None, :]
+        if not band.any(axis=1).all():
+            raise GISError("error lat:%s" % lat[~band.any(axis=1)][0])
+        ax = self._MC2LL[band.argmax(axis=1)]
+
+        e = ax[:, 0] + ax[:, 1] * np.abs(lon)
+        i = np.abs(lat) / ax[:, 9]
+        i2 = i * i
+        i3 = i2 * i
+        i4 = i3 * i
+        i5 = i4 * i
+        aw = ax[:, 2] + ax[:, 3] * i + ax[:, 4] * i2 + ax[:, 5] * i3 + \
+             ax[:, 6] * i4 + ax[:, 7] * i5 + ax[:, 8] * i5 * i
+        e = np.where(lon < 0, -e, e)
+        aw = np.where(lat < 0, -aw, aw)
+        return self._stack(e, aw)
+
+    def convert_MCT_2_BD09(self, lon, lat):
         """将墨卡托坐标转换成BD09
             Args:
                 lon: float, 经度
@@ -184,47 +265,25 @@ class GisTransformer(object):
             Returns:
                 (x, y): tuple, 经过转换的x, y
         """
-        ax = None
-
-        # 获取常量ax
-        for idx , mcband in enumerate(self.MCBAND):
-            if lat >= mcband:
-                ax = self.MC2LL[idx]
-                break
-
-        if ax is None:
-            raise GISError("error lat:%s" % lat)
-
-        e = ax[0] + ax[1] * abs(lon)
-        i = abs(lat) / ax[9]
-        aw = ax[2] + ax[3] * i + ax[4] * i * i + ax[5] * i * i * i +\
-             ax[6] * i * i * i * i + ax[7] * i * i * i * i * i + ax[8] * i * i * i * i * i * i
-        if lon < 0:
-            e *= -1
-        if lat < 0:
-            aw *= -1
-        return e, aw
-
-    def parseGeo(self , mocator):
-        results = []
+        return self._scalar(self.convert_MCT_2_BD09_array, lon, lat)
+
+    def parseGeo_array(self, mocator):
+        """
+        解析AOI接口的geo字段
+        :param mocator: geo字符串
+        :return: 每个围栏一个 (N, 2) 墨卡托坐标数组, bound字符串
+        """
         items = mocator.split("|")
         type_ = int(items[0])
-        bound , aois_str = items[1] , items[2].strip(";")
+        bound, aois_str = items[1], items[2].strip(";")
         aois = aois_str.split(";")
         if type_ == 4:
-            aois = [ aois_str.split("-")[1] for aoi in aois if aoi.split("-")[0] == '1']
+            aois = [aois_str.split("-")[1] for aoi in aois if aoi.split("-")[0] == '1']
         if type_ == 1:
-            results.append(aois[0])
-        else:
-            for aoi in aois:
-#                 if len(aoi) > 100:
-#                     aoi = re.sub('/(-?[1-9]\d*\.\d*|-?0\.\d*[1-9]\d*|-?0?\.0+|0|-?[1-9]\d*),(-?[1-9]\d*\.\d*|-?0\.\d*[1-9]\d*|-?0?\.0+|0|-?[1-9]\d*)(,)/g',"$1,$2;" , aoi)
-#                     results.append(aoi)
-#                 else:
-                aoi_rs = []
-                aoi_points = aoi.split(",")
-                for pidx in range(0, len(aoi_points), 2):
-                    aoi_rs.append([float(aoi_points[pidx]),float(aoi_points[pidx+1])])
-                results.append(aoi_rs)
-        return results , bound
-        
+            aois = aois[:1]
+        results = [np.array(aoi.split(","), dtype=np.float64).reshape(-1, 2) for aoi in aois]
+        return results, bound
+
+    def parseGeo(self, mocator):
+        results, bound = self.parseGeo_array(mocator)
+        return [aoi.tolist() for aoi in results], bound
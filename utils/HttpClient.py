@@ -0,0 +1,157 @@
+import time
+import random
+import threading
+import requests
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from utils.RetryScheduler import CircuitOpenError
+
+
+class ProxyPool(object):
+    """
+    本地代理池: 批量从代理服务预取代理, 按延迟与成功率打分, 淘汰劣质代理
+    """
+
+    def __init__(self, service, prefetch=20, min_size=5, min_requests=5, min_success_rate=0.5, alpha=0.3,
+                 breaker=None):
+        """
+        :param service: 代理服务地址, 如 http://10.126.138.150:5010
+        :param prefetch: 每次预取的代理数量
+        :param min_size: 池内代理少于该数量时补充
+        :param min_requests: 使用次数达到该值后才参与淘汰判断
+        :param min_success_rate: 成功率低于该值的代理被淘汰
+        :param alpha: 延迟指数滑动平均系数
+        :param breaker: 按代理熔断的CircuitBreaker, 冷却中的代理不参与选择
+        """
+        self.service = service.rstrip('/')
+        self.prefetch = prefetch
+        self.min_size = min_size
+        self.min_requests = min_requests
+        self.min_success_rate = min_success_rate
+        self.alpha = alpha
+        self.breaker = breaker
+        # proxy -> [请求次数, 成功次数, 平均延迟]
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._session = requests.Session()
+
+    def _fetch(self):
+        """
+        从代理服务批量获取代理, 兼容 get_all 返回字符串列表或字典列表
+        """
+        try:
+            proxies = self._session.get(self.service + '/get_all/', timeout=5).json()
+            proxies = [proxy.get('proxy') if isinstance(proxy, dict) else proxy for proxy in proxies]
+        except Exception:
+            proxies = []
+        if not proxies:
+            proxies = [self._session.get(self.service + '/get', timeout=5).text.strip()
+                       for _ in range(self.prefetch)]
+        return [proxy for proxy in proxies if proxy][:self.prefetch]
+
+    def _refill(self):
+        proxies = self._fetch()
+        with self._lock:
+            for proxy in proxies:
+                self._stats.setdefault(proxy, [0, 0, 1.0])
+
+    def _score(self, stat):
+        total, success, latency = stat
+        # 新代理按50%成功率估计, 保证有被试用的机会
+        rate = (success + 1) / (total + 2)
+        return rate / max(latency, 0.01)
+
+    def get(self):
+        """
+        按分数加权随机返回一个代理
+        :return: ip:port
+        """
+        if len(self._stats) < self.min_size:
+            self._refill()
+        with self._lock:
+            if not self._stats:
+                return None
+            proxies = list(self._stats.keys())
+            if self.breaker:
+                # 全部代理熔断时仍从全体中选择, 不退化为直连
+                proxies = [proxy for proxy in proxies if not self.breaker.is_open(proxy)] or proxies
+            weights = [self._score(self._stats[proxy]) for proxy in proxies]
+        return random.choices(proxies, weights=weights)[0]
+
+    def report(self, proxy, success, latency=None):
+        """
+        回报代理使用结果, 更新分数并淘汰劣质代理
+        """
+        if self.breaker:
+            self.breaker.record(proxy, success)
+        with self._lock:
+            stat = self._stats.get(proxy)
+            if stat is None:
+                return
+            stat[0] += 1
+            if success:
+                stat[1] += 1
+            if latency is not None:
+                stat[2] = self.alpha * latency + (1 - self.alpha) * stat[2]
+            if stat[0] >= self.min_requests and stat[1] / stat[0] < self.min_success_rate:
+                del self._stats[proxy]
+
+    def size(self):
+        return len(self._stats)
+
+
+class HttpClient(object):
+    """
+    按上游主机维护长连接Session, 可选接入本地代理池与按主机熔断
+    """
+
+    def __init__(self, headers=None, proxy_pool=None, pool_maxsize=20, timeout=30, breaker=None):
+        self.headers = headers
+        self.proxy_pool = proxy_pool
+        self.breaker = breaker
+        self.pool_maxsize = pool_maxsize
+        self.timeout = timeout
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def _get_session(self, host):
+        session = self._sessions.get(host)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(host)
+                if session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize)
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    if self.headers:
+                        session.headers.update(self.headers)
+                    self._sessions[host] = session
+        return session
+
+    def get_json(self, url):
+        """
+        :raise CircuitOpenError: 上游主机熔断中, 请求未发出
+        """
+        host = urlsplit(url).netloc
+        if self.breaker and not self.breaker.allow(host):
+            raise CircuitOpenError(host)
+        session = self._get_session(host)
+        proxy = self.proxy_pool.get() if self.proxy_pool else None
+        proxies = {"http": "http://" + proxy, "https": "http://" + proxy} if proxy else None
+
+        start = time.time()
+        try:
+            content = session.get(url, timeout=self.timeout, proxies=proxies).json()
+        except Exception:
+            # 经代理的失败计入代理, 直连失败计入上游主机
+            if proxy:
+                self.proxy_pool.report(proxy, False)
+            elif self.breaker:
+                self.breaker.record(host, False)
+            raise
+        if proxy:
+            self.proxy_pool.report(proxy, True, time.time() - start)
+        if self.breaker:
+            self.breaker.record(host, True)
+        return content
@@ -0,0 +1,90 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache(object):
+    """
+    本地SQLite响应缓存, 按 接口+uid 索引, 支持TTL过期、按总大小LRU淘汰与命中统计
+    """
+
+    def __init__(self, path, ttl, max_size, evict_interval=1000):
+        """
+        :param path: 缓存文件路径
+        :param ttl: 过期秒数
+        :param max_size: 缓存总字节数上限, 超过后按最近访问时间淘汰
+        :param evict_interval: 每写入多少条检查一次总大小
+        """
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.evict_interval = evict_interval
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._pid = None
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        # 连接不能跨进程共享, fork后重新打开
+        if self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, "
+                               "created REAL, accessed REAL, size INTEGER)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, endpoint, uid):
+        """
+        :return: 缓存值, 未命中或已过期返回None
+        """
+        key = endpoint + ':' + uid
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute("SELECT value, created FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                self.misses += 1
+                return None
+            conn.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, endpoint, uid, value):
+        key = endpoint + ':' + uid
+        value = json.dumps(value)
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)",
+                         (key, value, now, now, len(key) + len(value)))
+            self._writes += 1
+            if self._writes % self.evict_interval == 0:
+                self._evict(conn)
+
+    def _evict(self, conn):
+        conn.execute("DELETE FROM cache WHERE created < ?", (time.time() - self.ttl,))
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        if total <= self.max_size:
+            return
+        # 淘汰到上限的90%, 避免频繁触发
+        excess, keys = total - self.max_size * 0.9, []
+        for key, size in conn.execute("SELECT key, size FROM cache ORDER BY accessed"):
+            if excess <= 0:
+                break
+            keys.append((key,))
+            excess -= size
+        conn.executemany("DELETE FROM cache WHERE key = ?", keys)
+        logger.info("响应缓存: 淘汰 %d 条" % len(keys))
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / total if total else 0.0}
@@ -0,0 +1,150 @@
+import time
+import random
+import threading
+from collections import deque
+
+# 将到期的延迟任务原子地移入任务队列前端
+# KEYS: 延迟队列(zset), 任务队列
+# ARGV: 当前时间戳, 单次最多移动条数
+# 返回: 移动条数
+PROMOTE_SCRIPT = """
+local tasks = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+for _, task in ipairs(tasks) do
+    redis.call('ZREM', KEYS[1], task)
+    redis.call('LPUSH', KEYS[2], task)
+end
+return #tasks
+"""
+
+
+class CircuitOpenError(Exception):
+    """
+    熔断器打开, 本次请求未发出
+    """
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    按key(上游主机/代理)统计失败的熔断器: 窗口内失败达到阈值后打开, 冷却后放行一次试探请求
+    """
+
+    def __init__(self, threshold=20, window=60, cooldown=30):
+        """
+        :param threshold: 窗口内失败次数阈值
+        :param window: 统计窗口秒数
+        :param cooldown: 打开后冷却秒数
+        """
+        self.threshold = threshold
+        self.window = window
+        self.cooldown = cooldown
+        self._failures = {}
+        self._opened = {}
+        self._lock = threading.Lock()
+
+    def allow(self, key):
+        with self._lock:
+            opened = self._opened.get(key)
+            if opened is None:
+                return True
+            if time.time() - opened < self.cooldown:
+                return False
+            # 半开: 放行一次试探, 结果回报前其余请求继续等待冷却
+            self._opened[key] = time.time()
+            return True
+
+    def record(self, key, success):
+        now = time.time()
+        with self._lock:
+            if success:
+                self._failures.pop(key, None)
+                self._opened.pop(key, None)
+                return
+            if key in self._opened:
+                # 试探失败, 重新进入冷却
+                self._opened[key] = now
+                return
+            failures = self._failures.setdefault(key, deque())
+            failures.append(now)
+            while failures and now - failures[0] > self.window:
+                failures.popleft()
+            if len(failures) >= self.threshold:
+                self._opened[key] = now
+                failures.clear()
+
+    def is_open(self, key):
+        """
+        是否处于冷却中, 不占用半开试探名额
+        """
+        opened = self._opened.get(key)
+        return opened is not None and time.time() - opened < self.cooldown
+
+
+class RetryScheduler(object):
+    """
+    非阻塞重试: 失败任务按指数退避(带抖动)写入Redis有序集合延迟队列, 到期后移回任务队列,
+    超过最大次数转入死信队列
+    """
+
+    def __init__(self, r, task_db, delay_db, dead_db, max_attempts=5, base_delay=5, max_delay=600):
+        """
+        :param task_db: 任务队列
+        :param delay_db: 延迟队列, score为到期时间戳
+        :param dead_db: 死信队列
+        :param max_attempts: 最大重试次数
+        :param base_delay: 首次退避秒数
+        :param max_delay: 退避上限秒数
+        """
+        self.r = r
+        self.task_db = task_db
+        self.delay_db = delay_db
+        self.dead_db = dead_db
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._promote = r.register_script(PROMOTE_SCRIPT)
+
+    def backoff(self, attempt):
+        delay = min(self.max_delay, self.base_delay * 2 ** max(attempt - 1, 0))
+        # 抖动取 [delay/2, delay), 避免同批失败任务同时到期
+        return delay / 2.0 + random.random() * delay / 2.0
+
+    def schedule(self, task, attempt):
+        """
+        :param task: 序列化任务
+        :param attempt: 已失败次数
+        :return: 进入延迟队列返回True, 超过最大次数转入死信队列返回False
+        """
+        if attempt > self.max_attempts:
+            self.dead(task)
+            return False
+        self.r.zadd(self.delay_db, {task: time.time() + self.backoff(attempt)})
+        return True
+
+    def dead(self, task):
+        self.r.rpush(self.dead_db, task)
+
+    def promote(self, limit=100):
+        """
+        :return: 移回任务队列的任务数
+        """
+        return self._promote(keys=[self.delay_db, self.task_db], args=[time.time(), limit])
+
+
+class AsyncRetryScheduler(RetryScheduler):
+    """
+    RetryScheduler的asyncio版本, 需传入redis.asyncio连接
+    """
+
+    async def schedule(self, task, attempt):
+        if attempt > self.max_attempts:
+            await self.dead(task)
+            return False
+        await self.r.zadd(self.delay_db, {task: time.time() + self.backoff(attempt)})
+        return True
+
+    async def dead(self, task):
+        await self.r.rpush(self.dead_db, task)
+
+    async def promote(self, limit=100):
+        return await self._promote(keys=[self.delay_db, self.task_db], args=[time.time(), limit])
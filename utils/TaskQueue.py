@@ -0,0 +1,188 @@
+import os
+import time
+import socket
+import asyncio
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# 将租约过期worker的处理中任务移回任务队列前端
+# KEYS: 租约zset, 任务队列
+# ARGV: 当前时间戳, 处理中列表key前缀
+# 返回: 移回任务数
+REAP_SCRIPT = """
+local workers = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+local n = 0
+for _, worker in ipairs(workers) do
+    local processing = ARGV[2] .. worker
+    while redis.call('RPOPLPUSH', processing, KEYS[2]) do
+        n = n + 1
+    end
+    redis.call('ZREM', KEYS[1], worker)
+end
+return n
+"""
+
+
+class TaskQueue(object):
+    """
+    可靠任务队列: 阻塞领取任务并原子移入本worker的处理中列表, 完成后显式确认,
+    worker崩溃或重启后由租约过期回收任务
+    """
+
+    def __init__(self, r, task_db, worker_id=None, lease_timeout=600, reap_interval=60):
+        """
+        :param task_db: 任务队列
+        :param worker_id: worker标识, 默认 主机名:进程号
+        :param lease_timeout: 租约秒数, 超过未续约的worker视为失效
+        :param reap_interval: 回收检查间隔秒数
+        """
+        self.r = r
+        self.task_db = task_db
+        self.worker_id = worker_id or '%s:%d' % (socket.gethostname(), os.getpid())
+        self.lease_timeout = lease_timeout
+        self.reap_interval = reap_interval
+        self.lease_db = task_db + ':leases'
+        self.processing_prefix = task_db + ':processing:'
+        self.processing = self.processing_prefix + self.worker_id
+        self._last_reap = 0
+        self._reap = r.register_script(REAP_SCRIPT)
+
+    def get(self, timeout=5):
+        """
+        阻塞领取任务
+        :param timeout: 最长阻塞秒数
+        :return: 任务, 超时返回None
+        """
+        self.renew()
+        task = self.r.blmove(self.task_db, self.processing, timeout, 'LEFT', 'RIGHT')
+        if task:
+            return task.decode('utf8')
+
+    def get_many(self, count, timeout=5):
+        """
+        阻塞领取首个任务, 再非阻塞领取其余, 一次往返
+        :return: 任务列表, 超时返回空列表
+        """
+        task = self.get(timeout)
+        if not task:
+            return []
+        pipe = self.r.pipeline(transaction=False)
+        for _ in range(count - 1):
+            pipe.lmove(self.task_db, self.processing, 'LEFT', 'RIGHT')
+        return [task] + [item.decode('utf8') for item in pipe.execute() if item]
+
+    def ack(self, task):
+        """
+        确认任务完成, 从处理中列表移除
+        """
+        self.r.lrem(self.processing, 1, task)
+
+    def ack_many(self, tasks):
+        pipe = self.r.pipeline(transaction=False)
+        for task in tasks:
+            pipe.lrem(self.processing, 1, task)
+        pipe.execute()
+
+    def requeue(self):
+        """
+        本worker处理中列表移回任务队列前端, 用于固定worker_id的进程重启后重放未确认的任务
+        :return: 移回任务数
+        """
+        n = 0
+        while self.r.rpoplpush(self.processing, self.task_db):
+            n += 1
+        return n
+
+    def renew(self):
+        self.r.zadd(self.lease_db, {self.worker_id: time.time() + self.lease_timeout})
+
+    def start_heartbeat(self, interval=None):
+        """
+        后台线程定期续约, 单个任务耗时超过租约时不被其他worker回收; 进程退出后心跳停止, 租约照常过期
+        :param interval: 续约间隔秒数, 默认为租约的1/3
+        """
+        thread = threading.Thread(target=self._heartbeat, args=(interval or self.lease_timeout / 3.0,),
+                                  name='lease-heartbeat', daemon=True)
+        thread.start()
+        return thread
+
+    def _heartbeat(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.renew()
+            except Exception:
+                logger.exception("任务队列: %s 续约失败" % self.worker_id)
+
+    def reap(self, force=False):
+        """
+        回收租约过期worker的任务, 按 reap_interval 限频
+        :return: 回收任务数
+        """
+        if not force and time.time() - self._last_reap < self.reap_interval:
+            return 0
+        self._last_reap = time.time()
+        return self._reap(keys=[self.lease_db, self.task_db], args=[time.time(), self.processing_prefix])
+
+
+class AsyncTaskQueue(TaskQueue):
+    """
+    TaskQueue的asyncio版本, 需传入redis.asyncio连接, 每个进程一个worker_id,
+    由单个协程领取任务, 续约由心跳协程完成
+    """
+
+    async def get(self, timeout=5):
+        await self.renew()
+        task = await self.r.blmove(self.task_db, self.processing, timeout, 'LEFT', 'RIGHT')
+        if task:
+            return task.decode('utf8')
+
+    async def get_many(self, count, timeout=5):
+        task = await self.get(timeout)
+        if not task:
+            return []
+        pipe = self.r.pipeline(transaction=False)
+        for _ in range(count - 1):
+            pipe.lmove(self.task_db, self.processing, 'LEFT', 'RIGHT')
+        return [task] + [item.decode('utf8') for item in await pipe.execute() if item]
+
+    async def ack(self, task):
+        await self.r.lrem(self.processing, 1, task)
+
+    async def ack_many(self, tasks):
+        pipe = self.r.pipeline(transaction=False)
+        for task in tasks:
+            pipe.lrem(self.processing, 1, task)
+        await pipe.execute()
+
+    async def requeue(self):
+        n = 0
+        while await self.r.rpoplpush(self.processing, self.task_db):
+            n += 1
+        return n
+
+    async def renew(self):
+        await self.r.zadd(self.lease_db, {self.worker_id: time.time() + self.lease_timeout})
+
+    def start_heartbeat(self, interval=None):
+        """
+        在当前事件循环中启动续约协程
+        """
+        self._heartbeat_task = asyncio.create_task(self._heartbeat(interval or self.lease_timeout / 3.0))
+        return self._heartbeat_task
+
+    async def _heartbeat(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.renew()
+            except Exception:
+                logger.exception("任务队列: %s 续约失败" % self.worker_id)
+
+    async def reap(self, force=False):
+        if not force and time.time() - self._last_reap < self.reap_interval:
+            return 0
+        self._last_reap = time.time()
+        return await self._reap(keys=[self.lease_db, self.task_db], args=[time.time(), self.processing_prefix])
@@ -0,0 +1,129 @@
+import os
+import hashlib
+import numpy as np
+
+
+class TilePlanCache(object):
+    """
+    栅格检索模式的城市切片缓存: 行政区划文件预处理为WKB索引, 城市的geohash覆盖与矩形
+    按 (城市, geohash长度, 行政区划文件哈希) 存为npz, 输入不变时无需解析WKT与重新切片
+    """
+
+    def __init__(self, city_file, cache_dir, geohash_length):
+        """
+        :param city_file: 行政区划文件, 每行 省_市|...:WKT
+        :param cache_dir: 缓存目录
+        :param geohash_length: 切片geohash长度
+        """
+        self.city_file = city_file
+        self.cache_dir = cache_dir
+        self.geohash_length = geohash_length
+        self.file_hash = self._file_hash(city_file)
+        self._index = None
+        self._cities = None
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def _file_hash(path):
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                md5.update(chunk)
+        return md5.hexdigest()[:16]
+
+    @staticmethod
+    def _save(path, **arrays):
+        # 先写临时文件再替换, 多个进程同时推送时不会读到写了一半的缓存
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, path)
+
+    def _build_index(self, path):
+        from shapely.wkt import loads
+        provs, cities, offsets, wkbs = [], [], [0], []
+        with open(self.city_file, encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                label, wkt = line.strip().split(':', 1)
+                prov, city = label.split('|')[0].split('_')[:2]
+                wkb = loads(wkt).wkb
+                provs.append(prov)
+                cities.append(city)
+                wkbs.append(wkb)
+                offsets.append(offsets[-1] + len(wkb))
+        self._save(path, prov=np.array(provs), city=np.array(cities), offsets=np.array(offsets, dtype=np.int64),
+                   wkb=np.frombuffer(b''.join(wkbs), dtype=np.uint8))
+
+    @property
+    def index(self):
+        """
+        行政区划索引: prov, city, 以及WKB拼接字节 wkb 和各区划的起止偏移 offsets
+        """
+        if self._index is None:
+            path = os.path.join(self.cache_dir, 'index_%s.npz' % self.file_hash)
+            if not os.path.exists(path):
+                self._build_index(path)
+            with np.load(path) as data:
+                self._index = {name: data[name] for name in data.files}
+        return self._index
+
+    def provinces(self):
+        """
+        :return: {省: [市, ...]}, 按文件顺序
+        """
+        result = {}
+        for prov, city in zip(self.index['prov'].tolist(), self.index['city'].tolist()):
+            result.setdefault(prov, []).append(city)
+        return result
+
+    @property
+    def cities(self):
+        """
+        {市: 索引序号}
+        """
+        if self._cities is None:
+            self._cities = {city: i for i, city in enumerate(self.index['city'].tolist())}
+        return self._cities
+
+    def polygon(self, city):
+        from shapely.wkb import loads
+        i = self.cities[city]
+        offsets = self.index['offsets']
+        return loads(self.index['wkb'][offsets[i]:offsets[i + 1]].tobytes())
+
+    def _cover(self, city):
+        from utils.geohash import GeohashOperator
+        geo = GeohashOperator()
+        polygon = self.polygon(city)
+        geohashes = set()
+        for poly in getattr(polygon, 'geoms', [polygon]):
+            geohashes.update(geo.polygon_geohasher(poly, self.geohash_length, self.geohash_length, True))
+        geohashes = sorted(geohashes)
+        boxes = []
+        for geohash in geohashes:
+            left_down, right_top = geo.geohash_to_polygon(geohash, False)[:4:2]
+            boxes.append(list(left_down[::-1]) + list(right_top[::-1]))
+        return geohashes, boxes
+
+    def plan(self, city):
+        """
+        城市切片, 未命中缓存时计算并写入
+        :return: (geohash数组, n*4矩形数组 左下纬度,左下经度,右上纬度,右上经度)
+        """
+        key = hashlib.md5(city.encode('utf8')).hexdigest()[:16]
+        path = os.path.join(self.cache_dir, 'plan_%s_%d_%s.npz' % (self.file_hash, self.geohash_length, key))
+        if not os.path.exists(path):
+            geohashes, boxes = self._cover(city)
+            self._save(path, geohash=np.array(geohashes, dtype='S%d' % self.geohash_length),
+                       box=np.array(boxes, dtype=np.float64).reshape(-1, 4))
+        with np.load(path) as data:
+            return data['geohash'], data['box']
+
+    @staticmethod
+    def box_strings(boxes):
+        """
+        矩形数组转检索区域字符串 左下纬度,左下经度,右上纬度,右上经度
+        """
+        return [','.join(map(str, box)) for box in boxes.tolist()]
@@ -0,0 +1,226 @@
+import math
+import hashlib
+
+# 未访问过的uid加入已访问集合并推送结果, 一页结果一次往返
+# KEYS: 已访问集合, 结果队列
+# ARGV: uid1, result1, uid2, result2 ...
+# 返回: 推送条数
+ADD_AND_PUSH_SCRIPT = """
+local n = 0
+for i = 1, #ARGV, 2 do
+    if redis.call('SADD', KEYS[1], ARGV[i]) == 1 then
+        redis.call('RPUSH', KEYS[2], ARGV[i + 1])
+        n = n + 1
+    end
+end
+return n
+"""
+
+# 布隆过滤器版本: 每个uid对应k个位, 任一位为0即视为未访问
+# KEYS: 位图, 结果队列
+# ARGV: k, 之后每个结果依次为 k个位偏移, 序列化结果
+# 返回: 推送条数
+BLOOM_ADD_AND_PUSH_SCRIPT = """
+local k = tonumber(ARGV[1])
+local n = 0
+for i = 2, #ARGV, k + 1 do
+    local exists = true
+    for j = i, i + k - 1 do
+        if redis.call('GETBIT', KEYS[1], ARGV[j]) == 0 then
+            exists = false
+            break
+        end
+    end
+    if not exists then
+        for j = i, i + k - 1 do
+            redis.call('SETBIT', KEYS[1], ARGV[j], 1)
+        end
+        redis.call('RPUSH', KEYS[2], ARGV[i + k])
+        n = n + 1
+    end
+end
+return n
+"""
+
+
+class VisitedSet(object):
+    """
+    uid已访问集合, 批量查询与批量写入
+    """
+
+    def __init__(self, r, visit_db):
+        self.r = r
+        self.visit_db = visit_db
+        self._add_and_push = r.register_script(ADD_AND_PUSH_SCRIPT)
+
+    @staticmethod
+    def _args(results):
+        args = []
+        for uid, result in results:
+            args.extend([uid, result])
+        return args
+
+    def contains_many(self, uids):
+        """
+        批量查询uid是否已访问
+        :return: 与uids等长的bool列表
+        """
+        if not uids:
+            return []
+        return [bool(flag) for flag in self.r.smismember(self.visit_db, uids)]
+
+    def add_and_push(self, results, result_db):
+        """
+        将未访问过的结果原子地标记已访问并推送到结果队列
+        :param results: [(uid, 序列化结果), ...]
+        :return: 推送条数
+        """
+        if not results:
+            return 0
+        return self._add_and_push(keys=[self.visit_db, result_db], args=self._args(results))
+
+    def add_many(self, uids, key=None, chunk=1000):
+        """
+        批量标记已访问, 按 chunk 拆分为多条SADD在一次往返中发送, key 为空时写入当前集合
+        """
+        if not uids:
+            return
+        pipe = self.r.pipeline(transaction=False)
+        for i in range(0, len(uids), chunk):
+            pipe.sadd(key or self.visit_db, *uids[i:i + chunk])
+        pipe.execute()
+
+    def count(self):
+        return self.r.scard(self.visit_db)
+
+
+class BloomVisitedSet(VisitedSet):
+    """
+    基于Redis位图的布隆过滤器, 不依赖Redis模块, 内存与容量和误判率相关而与uid长度无关
+    """
+
+    def __init__(self, r, visit_db, capacity, error_rate):
+        """
+        :param visit_db: 位图key
+        :param capacity: 预计uid数量
+        :param error_rate: 达到容量时的误判率
+        """
+        self.r = r
+        self.visit_db = visit_db
+        self.capacity = capacity
+        self.error_rate = error_rate
+        # 位数 m = -n*ln(p)/ln(2)^2, 哈希数 k = m/n*ln(2), Redis字符串最多 2^32 位
+        self.bits = min(int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)), 2 ** 32)
+        self.hashes = max(1, int(round(self.bits / capacity * math.log(2))))
+        self._add_and_push = r.register_script(BLOOM_ADD_AND_PUSH_SCRIPT)
+
+    def _offsets(self, uid):
+        # 双重哈希生成k个位偏移
+        digest = hashlib.md5(uid.encode('utf8')).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def _args(self, results):
+        args = [self.hashes]
+        for uid, result in results:
+            args.extend(self._offsets(uid))
+            args.append(result)
+        return args
+
+    def _contains_pipeline(self, pipe, uids):
+        for uid in uids:
+            for offset in self._offsets(uid):
+                pipe.getbit(self.visit_db, offset)
+
+    def _split_flags(self, flags):
+        return [all(flags[i:i + self.hashes]) for i in range(0, len(flags), self.hashes)]
+
+    def contains_many(self, uids):
+        if not uids:
+            return []
+        pipe = self.r.pipeline(transaction=False)
+        self._contains_pipeline(pipe, uids)
+        return self._split_flags(pipe.execute())
+
+    def add_many(self, uids, key=None, chunk=1000):
+        if not uids:
+            return
+        pipe = self.r.pipeline(transaction=False)
+        for uid in uids:
+            for offset in self._offsets(uid):
+                pipe.setbit(key or self.visit_db, offset, 1)
+        pipe.execute()
+
+    def count(self):
+        """
+        按置位比例估算已访问uid数量
+        """
+        ones = self.r.bitcount(self.visit_db)
+        if ones >= self.bits:
+            return self.capacity
+        return int(-self.bits / self.hashes * math.log(1 - ones / self.bits))
+
+
+class AsyncVisitedSet(VisitedSet):
+    """
+    VisitedSet的asyncio版本, 需传入redis.asyncio连接
+    """
+
+    async def contains_many(self, uids):
+        if not uids:
+            return []
+        return [bool(flag) for flag in await self.r.smismember(self.visit_db, uids)]
+
+    async def add_and_push(self, results, result_db):
+        if not results:
+            return 0
+        return await self._add_and_push(keys=[self.visit_db, result_db], args=self._args(results))
+
+    async def add_many(self, uids, key=None, chunk=1000):
+        if not uids:
+            return
+        pipe = self.r.pipeline(transaction=False)
+        for i in range(0, len(uids), chunk):
+            pipe.sadd(key or self.visit_db, *uids[i:i + chunk])
+        await pipe.execute()
+
+
+class AsyncBloomVisitedSet(BloomVisitedSet):
+    """
+    BloomVisitedSet的asyncio版本, 需传入redis.asyncio连接
+    """
+
+    async def contains_many(self, uids):
+        if not uids:
+            return []
+        pipe = self.r.pipeline(transaction=False)
+        self._contains_pipeline(pipe, uids)
+        return self._split_flags(await pipe.execute())
+
+    async def add_and_push(self, results, result_db):
+        if not results:
+            return 0
+        return await self._add_and_push(keys=[self.visit_db, result_db], args=self._args(results))
+
+    async def add_many(self, uids, key=None, chunk=1000):
+        if not uids:
+            return
+        pipe = self.r.pipeline(transaction=False)
+        for uid in uids:
+            for offset in self._offsets(uid):
+                pipe.setbit(key or self.visit_db, offset, 1)
+        await pipe.execute()
+
+
+def get_visited_set(r, conf, is_async=False):
+    """
+    按 [redis] visit_backend 配置创建已访问集合, set 为Redis集合, bloom 为布隆过滤器
+    """
+    visit_db = conf.get('redis', 'visit_db')
+    if conf.get('redis', 'visit_backend') == 'bloom':
+        cls = AsyncBloomVisitedSet if is_async else BloomVisitedSet
+        return cls(r, visit_db + ':bloom', conf.getint('redis', 'bloom_capacity'),
+                   conf.getfloat('redis', 'bloom_error_rate'))
+    cls = AsyncVisitedSet if is_async else VisitedSet
+    return cls(r, visit_db)
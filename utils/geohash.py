@@ -4,16 +4,234 @@ Created on 2020/8/10 14:59
 
 @author: sun shaowen
 """
-import queue
 import geohash
+import shapely
 import numpy as np
 from itertools import product
 from scipy.ndimage import convolve
-from shapely.ops import cascaded_union
+from shapely.ops import unary_union
+from shapely.prepared import prep
 from shapely.geometry import box, Polygon
 from shapely.geometry.base import BaseGeometry
 
 
+class _GeohashGrid(object):
+    """
+    固定精度的geohash栅格, 单元以整数 (行, 列) 表示, 行自南向北, 列自西向东;
+    单元边界为 -90 + 行*纬度步长 等二进制精确值, 与 geohash.decode_exactly 得到的矩形一致
+    """
+    # 行列组合键 行 << 32 | 列
+    SHIFT = 32
+    BASE32 = np.frombuffer(b"0123456789bcdefghjkmnpqrstuvwxyz", dtype=np.uint8)
+    # 判定边界单元的容差(度), 远小于12位geohash的宽度
+    EPS = 1e-10
+
+    def __init__(self, precision: int):
+        self.precision = precision
+        self.lat_bits = 5 * precision // 2
+        self.lon_bits = 5 * precision - self.lat_bits
+        self.dlat = 180.0 / 2 ** self.lat_bits
+        self.dlon = 360.0 / 2 ** self.lon_bits
+
+    def key(self, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+        return (rows << self.SHIFT) + cols
+
+    def bounds(self, rows: np.ndarray, cols: np.ndarray) -> tuple:
+        south = -90.0 + rows * self.dlat
+        west = -180.0 + cols * self.dlon
+        return west, south, west + self.dlon, south + self.dlat
+
+    def encode(self, rows: np.ndarray, cols: np.ndarray) -> set:
+        """
+        行列交错为geohash位串(首位为经度)后按5位一组查表
+        """
+        code = np.zeros(len(rows), dtype=np.int64)
+        lon_bit, lat_bit = self.lon_bits, self.lat_bits
+        for i in range(5 * self.precision):
+            if i % 2 == 0:
+                lon_bit -= 1
+                code = (code << 1) | ((cols >> lon_bit) & 1)
+            else:
+                lat_bit -= 1
+                code = (code << 1) | ((rows >> lat_bit) & 1)
+        shifts = 5 * np.arange(self.precision - 1, -1, -1)
+        chars = self.BASE32[(code[:, None] >> shifts) & 31]
+        return set(np.ascontiguousarray(chars).view('S%d' % self.precision).ravel().astype('U').tolist())
+
+    def children(self, rows: np.ndarray, cols: np.ndarray) -> tuple:
+        """
+        下一精度的栅格与全部32个子单元
+        """
+        grid = _GeohashGrid(self.precision + 1)
+        row_bits, col_bits = grid.lat_bits - self.lat_bits, grid.lon_bits - self.lon_bits
+        sub_rows, sub_cols = np.divmod(np.arange(32), 2 ** col_bits)
+        return (grid, ((rows[:, None] << row_bits) + sub_rows).ravel(),
+                ((cols[:, None] << col_bits) + sub_cols).ravel())
+
+    def boundary_runs(self, edges: np.ndarray, eps: float = EPS) -> tuple:
+        """
+        边界经过的单元, 按行合并为连续列区间
+        :param eps: 为正时包含与边界距离在eps内的单元; 为负时只包含边界穿过其内部(距单元边缘超过-eps)的单元
+        :return: 区间起点键(已排序), 区间终点列
+        """
+        x0, y0, x1, y1 = edges.T
+        y_min, y_max = np.minimum(y0, y1), np.maximum(y0, y1)
+        first = np.floor((y_min - abs(eps) + 90.0) / self.dlat).astype(np.int64)
+        last = np.floor((y_max + abs(eps) + 90.0) / self.dlat).astype(np.int64)
+        counts = last - first + 1
+        index = np.repeat(np.arange(len(edges)), counts)
+        rows = first[index] + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        # 边在每一行(上下扩或缩eps)内的经度范围
+        south = -90.0 + rows * self.dlat
+        y_a = np.maximum(y_min[index], south - eps)
+        y_b = np.minimum(y_max[index], south + self.dlat + eps)
+        dy = (y1 - y0)[index]
+        flat = dy == 0
+        slope = np.where(flat, 0.0, (x1 - x0)[index] / np.where(flat, 1.0, dy))
+        x_a = np.where(flat, np.minimum(x0, x1)[index], x0[index] + (y_a - y0[index]) * slope)
+        x_b = np.where(flat, np.maximum(x0, x1)[index], x0[index] + (y_b - y0[index]) * slope)
+        starts = np.floor((np.minimum(x_a, x_b) - eps + 180.0) / self.dlon).astype(np.int64)
+        if eps > 0:
+            ends = np.floor((np.maximum(x_a, x_b) + eps + 180.0) / self.dlon).astype(np.int64)
+            valid = y_a <= y_b
+        else:
+            ends = np.ceil((np.maximum(x_a, x_b) + eps + 180.0) / self.dlon).astype(np.int64) - 1
+            valid = (y_a <= y_b) & (starts <= ends)
+        rows, starts, ends = rows[valid], starts[valid], ends[valid]
+        if not len(rows):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        order = np.lexsort((starts, rows))
+        rows, starts, ends = rows[order], starts[order], ends[order]
+        # 同一行内与前面区间重叠或相邻的合并
+        reach = np.maximum.accumulate(self.key(rows, ends))
+        new = np.ones(len(rows), dtype=bool)
+        new[1:] = self.key(rows, starts)[1:] > reach[:-1] + 1
+        group = np.cumsum(new) - 1
+        merged_ends = np.zeros(group[-1] + 1, dtype=np.int64)
+        np.maximum.at(merged_ends, group, ends)
+        return self.key(rows[new], starts[new]), merged_ends
+
+    def in_runs(self, runs: tuple, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+        starts, ends = runs
+        if not len(starts):
+            return np.zeros(len(rows), dtype=bool)
+        keys = self.key(rows, cols)
+        index = np.searchsorted(starts, keys, side='right') - 1
+        found = index >= 0
+        index = np.maximum(index, 0)
+        return found & (starts[index] >> self.SHIFT == rows) & (ends[index] >= cols)
+
+    def run_cells(self, runs: tuple) -> tuple:
+        starts, ends = runs
+        rows, cols = starts >> self.SHIFT, starts & ((1 << self.SHIFT) - 1)
+        counts = ends - cols + 1
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return np.repeat(rows, counts), np.repeat(cols, counts) + offsets
+
+    def crossings(self, edges: np.ndarray) -> np.ndarray:
+        """
+        各行中心线与边界的交点, 以 行 << 32 | 交点右侧第一个单元中心的列 表示
+        :return: 已排序的键, 每行个数为偶数
+        """
+        x0, y0, x1, y1 = edges.T
+        y_min, y_max = np.minimum(y0, y1), np.maximum(y0, y1)
+        first = np.floor((y_min + 90.0) / self.dlat - 0.5).astype(np.int64)
+        last = np.ceil((y_max + 90.0) / self.dlat - 0.5).astype(np.int64)
+        counts = np.maximum(last - first + 1, 0)
+        index = np.repeat(np.arange(len(edges)), counts)
+        rows = first[index] + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        center = -90.0 + (rows + 0.5) * self.dlat
+        # 半开规则: 边的两个端点恰有一个在中心线以下(含)
+        hit = (y0[index] <= center) != (y1[index] <= center)
+        index, rows, center = index[hit], rows[hit], center[hit]
+        x = x0[index] + (center - y0[index]) * (x1 - x0)[index] / (y1 - y0)[index]
+        cols = np.floor((x + 180.0) / self.dlon - 0.5).astype(np.int64) + 1
+        return np.sort(self.key(rows, cols))
+
+    def inside(self, crossings: np.ndarray, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+        """
+        奇偶规则判断单元中心是否在多边形内
+        """
+        left = np.searchsorted(crossings, self.key(rows, cols), side='right')
+        row_start = np.searchsorted(crossings, self.key(rows, np.zeros_like(cols)), side='left')
+        return (left - row_start) % 2 == 1
+
+    def inside_cells(self, crossings: np.ndarray) -> tuple:
+        """
+        中心在多边形内的全部单元
+        """
+        starts, ends = crossings[0::2], crossings[1::2]
+        counts = ends - starts
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        keys = np.repeat(starts, counts) + offsets
+        return keys >> self.SHIFT, keys & ((1 << self.SHIFT) - 1)
+
+    def relate(self, polygon: BaseGeometry, rows: np.ndarray, cols: np.ndarray) -> tuple:
+        """
+        用预处理几何判断单元与多边形的 contains / intersects
+        """
+        if not len(rows):
+            return np.zeros(0, dtype=bool), np.zeros(0, dtype=bool)
+        west, south, east, north = self.bounds(rows, cols)
+        if hasattr(shapely, 'prepare'):
+            # 顶点顺序与 GeohashOperator.geohash_to_polygon 一致
+            rings = np.stack([np.stack([west, east, east, west, west], axis=1),
+                              np.stack([south, south, north, north, south], axis=1)], axis=2)
+            cells = shapely.polygons(rings)
+            shapely.prepare(polygon)
+            intersects = shapely.intersects(polygon, cells)
+            contains = np.zeros(len(cells), dtype=bool)
+            contains[intersects] = shapely.contains(polygon, cells[intersects])
+        else:
+            prepared = prep(polygon)
+            cells = [Polygon([(w, s), (e, s), (e, n), (w, n), (w, s)])
+                     for w, s, e, n in zip(west.tolist(), south.tolist(), east.tolist(), north.tolist())]
+            intersects = np.array([prepared.intersects(cell) for cell in cells], dtype=bool)
+            contains = np.array([flag and prepared.contains(cell) for flag, cell in zip(intersects, cells)], dtype=bool)
+        return contains, intersects
+
+    def classify(self, polygon: BaseGeometry, edges: np.ndarray, rows: np.ndarray = None,
+                 cols: np.ndarray = None) -> tuple:
+        """
+        将单元分为 被包含 / 相交未包含 两类, 只有边界单元需要几何判断, 其余按扫描线奇偶判断
+        :param rows: 候选单元行号, 为空时为整个多边形
+        :return: 被包含单元 (行, 列), 相交未包含单元 (行, 列)
+        """
+        runs = self.boundary_runs(edges)
+        crossings = self.crossings(edges)
+        if rows is None:
+            boundary_rows, boundary_cols = self.run_cells(runs)
+            inside_rows, inside_cols = self.inside_cells(crossings)
+            interior = ~self.in_runs(runs, inside_rows, inside_cols)
+        else:
+            on_boundary = self.in_runs(runs, rows, cols)
+            boundary_rows, boundary_cols = rows[on_boundary], cols[on_boundary]
+            inside_rows, inside_cols = rows[~on_boundary], cols[~on_boundary]
+            interior = self.inside(crossings, inside_rows, inside_cols)
+        inside_rows, inside_cols = inside_rows[interior], inside_cols[interior]
+        # 边界穿过内部的单元必然相交且不被包含, 其余只与边界相距eps内的单元做几何判断
+        crossing = self.in_runs(self.boundary_runs(edges, -self.EPS), boundary_rows, boundary_cols)
+        contains, intersects = np.zeros_like(crossing), crossing.copy()
+        contains[~crossing], intersects[~crossing] = self.relate(polygon, boundary_rows[~crossing],
+                                                                 boundary_cols[~crossing])
+        crossing = intersects & ~contains
+        return ((np.concatenate([inside_rows, boundary_rows[contains]]),
+                 np.concatenate([inside_cols, boundary_cols[contains]])),
+                (boundary_rows[crossing], boundary_cols[crossing]))
+
+    @staticmethod
+    def edges(polygon: BaseGeometry) -> np.ndarray:
+        """
+        多边形内外环的全部边 [x0, y0, x1, y1]
+        """
+        edges = []
+        for part in getattr(polygon, 'geoms', [polygon]):
+            for ring in [part.exterior] + list(part.interiors):
+                coords = np.asarray(ring.coords, dtype=np.float64)[:, :2]
+                edges.append(np.hstack([coords[:-1], coords[1:]]))
+        return np.vstack(edges)
+
+
 class GeohashOperator(object):
     """
     Geohash操作类
@@ -282,6 +500,8 @@ class GeohashOperator(object):
         """
         将目标几何图形切割成geohash，并输出包含与相交两个geohash字符串列表
 
+        在整数行列栅格上按扫描线判断内部块，只对边界块做几何判断
+
         Parameters
         ----------
         polygon : shapely.geometry.Polygon
@@ -310,28 +530,9 @@ class GeohashOperator(object):
         ----------
         geohash_to_polygon : 将Geohash字符串转成矩形
         """
-        inner_geohashes = set()
-        outer_geohashes = set()
-        intersect_geohashes = set()
-        testing_geohashes = queue.Queue()
-        testing_geohashes.put(geohash.encode(polygon.exterior.xy[1][0], polygon.exterior.xy[0][0], precision))
-        while not testing_geohashes.empty():
-            current_geohash = testing_geohashes.get()
-            if current_geohash not in inner_geohashes and current_geohash not in outer_geohashes:
-                current_polygon = self.geohash_to_polygon(current_geohash)
-                condition = polygon.intersects(current_polygon)
-                if condition:
-                    if polygon.contains(current_polygon):
-                        inner_geohashes.add(current_geohash)
-                    elif polygon.intersects(current_polygon):
-                        intersect_geohashes.add(current_geohash)
-                        outer_geohashes.add(current_geohash)
-                    else:
-                        outer_geohashes.add(current_geohash)
-                    for neighbor in geohash.neighbors(current_geohash):
-                        if neighbor not in inner_geohashes and neighbor not in outer_geohashes:
-                            testing_geohashes.put(neighbor)
-        return inner_geohashes, intersect_geohashes
+        grid = _GeohashGrid(precision)
+        (inner_rows, inner_cols), (intersect_rows, intersect_cols) = grid.classify(polygon, grid.edges(polygon))
+        return grid.encode(inner_rows, inner_cols), grid.encode(intersect_rows, intersect_cols)
 
     def geohashes_to_polygon(self, geohashes: list) -> Polygon:
         """
@@ -354,27 +555,7 @@ class GeohashOperator(object):
 
         返回一个unicom之后的集合对象
         """
-        return cascaded_union([self.geohash_to_polygon(g) for g in geohashes])
-
-    def __get_tmp_res(self, res: set, intersect_geohash: str, test_poly: BaseGeometry, tmp_precision: int,
-                      stop_precision: int, intersect: bool):
-        geohash_list = ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9', 'b', 'c', 'd', 'e', 'f', 'g', 'h', 'j', 'k',
-                        'm', 'n', 'p', 'q', 'r', 's', 't', 'u', 'v', 'w', 'x', 'y', 'z']
-        tmp_precision += 1
-        for add_on in geohash_list:
-            tmp_poly = self.geohash_to_polygon(intersect_geohash + add_on)
-            if test_poly.contains(tmp_poly):
-                res.add(intersect_geohash + add_on)
-            elif test_poly.intersects(tmp_poly):
-                if tmp_precision == stop_precision:
-                    if intersect is True:
-                        res.add(intersect_geohash + add_on)
-                else:
-                    res = res.union(
-                        self.__get_tmp_res(res, intersect_geohash + add_on, test_poly, tmp_precision, stop_precision,
-                                           intersect)
-                    )
-        return res
+        return unary_union([self.geohash_to_polygon(g) for g in geohashes])
 
     def polygon_geohasher(self, input_poly: Polygon, start_precision: int, stop_precision: int,
                           intersect: bool = True) -> list:
@@ -414,17 +595,21 @@ class GeohashOperator(object):
         ----------
         polygon_to_multi_length_geohashes : 将目标几何图形切割成geohash，并输出包含与相交两个geohash字符串列表
         """
-        res = set()
-        inner_geohashes_1, intersect_geohashes_1 = self.polygon_to_multi_length_geohashes(input_poly, start_precision)
+        grid = _GeohashGrid(start_precision)
+        edges = grid.edges(input_poly)
+        (inner_rows, inner_cols), (intersect_rows, intersect_cols) = grid.classify(input_poly, edges)
+        res = grid.encode(inner_rows, inner_cols)
         if start_precision == stop_precision:
             if intersect is True:
-                inner_geohashes_1.update(intersect_geohashes_1)
-            return inner_geohashes_1
-        if len(intersect_geohashes_1) > 0:
-            res = res.union(inner_geohashes_1)
-            for intersect_geohashe in intersect_geohashes_1:
-                res = res.union(
-                    self.__get_tmp_res(res, intersect_geohashe, input_poly, start_precision, stop_precision, intersect))
-        else:
-            res = res.union(self.polygon_geohasher(input_poly, start_precision + 1, stop_precision, intersect))
+                res.update(grid.encode(intersect_rows, intersect_cols))
+            return res
+        if len(intersect_rows) == 0:
+            return self.polygon_geohasher(input_poly, start_precision + 1, stop_precision, intersect)
+        # 只细分相交未包含的块, 被包含的子块直接加入结果
+        while grid.precision < stop_precision:
+            grid, rows, cols = grid.children(intersect_rows, intersect_cols)
+            (inner_rows, inner_cols), (intersect_rows, intersect_cols) = grid.classify(input_poly, edges, rows, cols)
+            res.update(grid.encode(inner_rows, inner_cols))
+        if intersect is True:
+            res.update(grid.encode(intersect_rows, intersect_cols))
         return res